@@ -22,12 +22,14 @@ import sys
 import breezy.bzr
 
 from .main import (
+    get_parallel_workers,
     get_prepared_branch_from_location,
     get_old_recipe,
     write_manifest_to_transport,
     )
 
 from .recipe import (
+    BranchCache,
     build_tree,
     resolve_revisions,
     )
@@ -60,6 +62,11 @@ def main():
         "--if-changed-from", metavar="PATH", help=(
             "Only build if the outcome would be different to that "
             "specified in this manifest."), type=str)
+    parser.add_argument(
+        "--lightweight", action="store_true", help=(
+            "Create nested branches that nothing is merged in to as "
+            "lightweight checkouts.  Only use this when the working "
+            "directory is thrown away after the build."))
 
     args = parser.parse_args()
 
@@ -68,6 +75,7 @@ def main():
     else:
         revspec = None
     possible_transports = []
+    max_workers = get_parallel_workers()
     base_branch = get_prepared_branch_from_location(
         args.location, possible_transports=possible_transports,
         revspec=revspec)
@@ -75,13 +83,25 @@ def main():
         old_recipe = get_old_recipe(args.if_changed_from, possible_transports)
     else:
         old_recipe = None
-    changed = resolve_revisions(base_branch, if_changed_from=old_recipe)
-    if not changed:
-        sys.stderr.write("Unchanged\n")
-        return 0
-    manifest_path = args.manifest or os.path.join(
-        args.working_basedir, "bzr-builder.manifest")
-    build_tree(base_branch, args.working_basedir)
+    # Share the branches and revisions that are resolved between the check
+    # and the build, so that what is built is what was compared.
+    with BranchCache(possible_transports) as branch_cache:
+        # Without a manifest to compare against there is nothing to resolve
+        # up front; build_tree resolves each branch as it gets to it.
+        if old_recipe is not None:
+            changed = resolve_revisions(
+                base_branch, if_changed_from=old_recipe,
+                branch_cache=branch_cache, max_workers=max_workers)
+            if not changed:
+                sys.stderr.write("Unchanged\n")
+                return 0
+        manifest_path = args.manifest or os.path.join(
+            args.working_basedir, "bzr-builder.manifest")
+        build_tree(
+            base_branch, args.working_basedir,
+            possible_transports=possible_transports,
+            branch_cache=branch_cache, lightweight=args.lightweight,
+            max_workers=max_workers)
     write_manifest_to_transport(
         manifest_path, base_branch, possible_transports)
 
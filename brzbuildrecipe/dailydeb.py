@@ -30,6 +30,7 @@ from breezy import (
     )
 
 from .recipe import (
+    BranchCache,
     build_tree,
     resolve_revisions,
     )
@@ -50,6 +51,7 @@ from .deb_version import (
     )
 from .main import (
     get_old_recipe,
+    get_parallel_workers,
     get_prepared_branch_from_location,
     write_manifest_to_transport,
     )
@@ -115,6 +117,7 @@ def main():
     args = parser.parse_args()
 
     possible_transports = []
+    max_workers = get_parallel_workers()
     base_branch = get_prepared_branch_from_location(
         args.location, safe=args.safe, possible_transports=possible_transports)
     # Save the unsubstituted version
@@ -126,105 +129,127 @@ def main():
     if base_branch.deb_version is not None:
         time = datetime.datetime.utcnow()
         substitute_time(base_branch, time)
-        changed = resolve_revisions(
-            base_branch, if_changed_from=old_recipe,
-            substitute_branch_vars=substitute_branch_vars)
-        check_expanded_deb_version(base_branch)
-    else:
-        changed = resolve_revisions(base_branch, if_changed_from=old_recipe)
-    if not changed:
-        sys.stderr.write("Unchanged\n")
-        return 0
-    if args.working_basedir is None:
-        temp_dir = tempfile.mkdtemp(prefix="bzr-builder-")
-        args.working_basedir = temp_dir
-    else:
-        temp_dir = None
-        if not os.path.exists(args.working_basedir):
-            os.makedirs(args.working_basedir)
-    package_name = _calculate_package_name(args.location, args.package)
-    if template_version is None:
-        working_directory = os.path.join(
-            args.working_basedir, "%s-direct" % (package_name,))
-    else:
-        working_directory = os.path.join(
-            args.working_basedir, "%s-%s" % (package_name, template_version))
-    try:
-        # we want to use a consistent package_dir always to support
-        # updates in place, but debuild etc want PACKAGE-UPSTREAMVERSION
-        # on disk, so we build_tree with the unsubstituted version number
-        # and do a final rename-to step before calling into debian build
-        # tools. We then rename the working dir back.
-        manifest_path = os.path.join(
-            working_directory, "debian", "bzr-builder.manifest")
-        build_tree(base_branch, working_directory)
-        control_path = os.path.join(working_directory, "debian", "control")
-        if not os.path.exists(control_path):
-            if args.package is None:
-                raise errors.BzrCommandError(
-                    "No control file to "
-                    "take the package name from, and --package not "
-                    "specified.")
+    # Share the branches and revisions that are resolved for the version and
+    # the check with the build, so that what is built is what they used.
+    with BranchCache(possible_transports) as branch_cache:
+        if (base_branch.deb_version is not None
+                and "{" in base_branch.deb_version):
+            changed = resolve_revisions(
+                base_branch, if_changed_from=old_recipe,
+                substitute_branch_vars=substitute_branch_vars,
+                branch_cache=branch_cache, max_workers=max_workers)
+        elif old_recipe is not None:
+            changed = resolve_revisions(
+                base_branch, if_changed_from=old_recipe,
+                branch_cache=branch_cache, max_workers=max_workers)
         else:
-            args.package = debian_source_package_name(control_path)
-        write_manifest_to_transport(
-            manifest_path, base_branch, possible_transports)
-        autobuild = (base_branch.deb_version is not None)
-        if autobuild:
-            # Add changelog also substitutes {debupstream}.
-            add_autobuild_changelog_entry(
-                base_branch, working_directory, args.package,
-                distribution=args.distribution,
-                append_version=args.append_version)
+            # Nothing to compare against or to substitute, so leave resolving
+            # each branch to build_tree.
+            changed = True
+        if base_branch.deb_version is not None:
+            check_expanded_deb_version(base_branch)
+        if not changed:
+            sys.stderr.write("Unchanged\n")
+            return 0
+        if args.working_basedir is None:
+            temp_dir = tempfile.mkdtemp(prefix="bzr-builder-")
+            args.working_basedir = temp_dir
         else:
-            if args.append_version:
-                raise errors.BzrCommandError(
-                    "--append-version only "
-                    "supported for autobuild recipes (with a 'deb-version' "
-                    "header)")
-        cl_path = os.path.join(working_directory, "debian", "changelog")
-        with open(cl_path) as cl_f:
-            contents = cl_f.read()
-        cl = changelog.Changelog(file=contents)
-        package_name = cl.package
-        package_version = cl.version
-        package_dir = calculate_package_dir(
-            package_name, package_version, args.working_basedir)
-        # working_directory -> package_dir: after this debian stuff works.
-        os.rename(working_directory, package_dir)
+            temp_dir = None
+            if not os.path.exists(args.working_basedir):
+                os.makedirs(args.working_basedir)
+        package_name = _calculate_package_name(args.location, args.package)
+        if template_version is None:
+            working_directory = os.path.join(
+                args.working_basedir, "%s-direct" % (package_name,))
+        else:
+            working_directory = os.path.join(
+                args.working_basedir,
+                "%s-%s" % (package_name, template_version))
         try:
-            current_format = get_source_format(package_dir)
-            if (package_version.debian_version is not None or
-                    current_format == "3.0 (quilt)"):
-                # Non-native package
-                try:
-                    extract_upstream_tarball(
-                        base_branch.branch, package_name,
-                        package_version.upstream_version, args.working_basedir)
-                except errors.NoSuchTag as e:
-                    if not args.allow_fallback_to_native:
-                        raise errors.BzrCommandError(
-                            "Unable to find the upstream source. Import it "
-                            "as tag %s or build with "
-                            "--allow-fallback-to-native." % e.tag_name)
-                    else:
-                        force_native_format(package_dir, current_format)
-            if args.build:
-                build_source_package(
-                    package_dir, tgz_check=not args.allow_fallback_to_native)
-        finally:
-            if args.build:
-                # package_dir -> working_directory
-                # FIXME: may fail in error unwind, masking the
-                # original exception.
-                os.rename(package_dir, working_directory)
-        # Note that this may write a second manifest.
-        if args.manifest is not None:
+            # we want to use a consistent package_dir always to support
+            # updates in place, but debuild etc want PACKAGE-UPSTREAMVERSION
+            # on disk, so we build_tree with the unsubstituted version number
+            # and do a final rename-to step before calling into debian build
+            # tools. We then rename the working dir back.
+            manifest_path = os.path.join(
+                working_directory, "debian", "bzr-builder.manifest")
+            # A fresh temporary directory is thrown away afterwards, so nested
+            # branches there don't need their own copy of the history.
+            build_tree(
+                base_branch, working_directory,
+                possible_transports=possible_transports,
+                branch_cache=branch_cache, lightweight=temp_dir is not None,
+                max_workers=max_workers)
+            control_path = os.path.join(working_directory, "debian", "control")
+            if not os.path.exists(control_path):
+                if args.package is None:
+                    raise errors.BzrCommandError(
+                        "No control file to "
+                        "take the package name from, and --package not "
+                        "specified.")
+            else:
+                args.package = debian_source_package_name(control_path)
             write_manifest_to_transport(
-                args.manifest, base_branch, possible_transports)
-    finally:
-        if temp_dir is not None:
-            shutil.rmtree(temp_dir)
+                manifest_path, base_branch, possible_transports)
+            autobuild = (base_branch.deb_version is not None)
+            if autobuild:
+                # Add changelog also substitutes {debupstream}.
+                add_autobuild_changelog_entry(
+                    base_branch, working_directory, args.package,
+                    distribution=args.distribution,
+                    append_version=args.append_version)
+            else:
+                if args.append_version:
+                    raise errors.BzrCommandError(
+                        "--append-version only "
+                        "supported for autobuild recipes (with a "
+                        "'deb-version' header)")
+            cl_path = os.path.join(working_directory, "debian", "changelog")
+            with open(cl_path) as cl_f:
+                contents = cl_f.read()
+            cl = changelog.Changelog(file=contents)
+            package_name = cl.package
+            package_version = cl.version
+            package_dir = calculate_package_dir(
+                package_name, package_version, args.working_basedir)
+            # working_directory -> package_dir: after this debian stuff works.
+            os.rename(working_directory, package_dir)
+            try:
+                current_format = get_source_format(package_dir)
+                if (package_version.debian_version is not None or
+                        current_format == "3.0 (quilt)"):
+                    # Non-native package
+                    try:
+                        extract_upstream_tarball(
+                            base_branch.branch, package_name,
+                            package_version.upstream_version,
+                            args.working_basedir)
+                    except errors.NoSuchTag as e:
+                        if not args.allow_fallback_to_native:
+                            raise errors.BzrCommandError(
+                                "Unable to find the upstream source. Import "
+                                "it as tag %s or build with "
+                                "--allow-fallback-to-native." % e.tag_name)
+                        else:
+                            force_native_format(package_dir, current_format)
+                if args.build:
+                    build_source_package(
+                        package_dir,
+                        tgz_check=not args.allow_fallback_to_native)
+            finally:
+                if args.build:
+                    # package_dir -> working_directory
+                    # FIXME: may fail in error unwind, masking the
+                    # original exception.
+                    os.rename(package_dir, working_directory)
+            # Note that this may write a second manifest.
+            if args.manifest is not None:
+                write_manifest_to_transport(
+                    args.manifest, base_branch, possible_transports)
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir)
 
 
 def _calculate_package_name(recipe_location, package):
@@ -15,13 +15,15 @@
 
 """Debian-specific utility functions."""
 
-from base64 import standard_b64decode
+import binascii
+from concurrent import futures
 from email import utils
 import errno
 import os
 import shutil
 import signal
 import subprocess
+import tempfile
 
 from breezy import (
     errors,
@@ -40,6 +42,17 @@ from debian import changelog, deb822
 # The default distribution used by add_autobuild_changelog_entry()
 DEFAULT_UBUNTU_DISTRIBUTION = "lucid"
 
+# Revision properties that can hold a pristine-tar delta, and the compression
+# of the tarball each of them reconstructs.
+PRISTINE_DELTA_PROPERTIES = [
+    ("deb-pristine-delta", "gz"),
+    ("deb-pristine-delta-bz2", "bz2"),
+    ]
+
+# Number of base64 characters decoded at a time when writing out a
+# pristine-tar delta.
+DELTA_CHUNK_SIZE = 76 * 1024
+
 
 class MissingDependency(errors.BzrError):
     pass
@@ -54,21 +67,42 @@ def debian_source_package_name(control_path):
         return control["Source"]
 
 
-def reconstruct_pristine_tar(dest, delta, dest_filename):
+def reconstruct_pristine_tar(dest, delta_path, dest_filename):
     """Reconstruct a pristine tarball from a directory and a delta.
 
     :param dest: Directory to pack
-    :param delta: pristine-tar delta
+    :param delta_path: Path to a file with the pristine-tar delta
     :param dest_filename: Destination filename
     """
-    command = ["pristine-tar", "gentar", "-",
+    command = ["pristine-tar", "gentar", os.path.abspath(delta_path),
                os.path.abspath(dest_filename)]
     _run_command(
         command, dest,
         "Reconstructing pristine tarball",
         "Generating tar from delta failed",
-        not_installed_msg="pristine-tar is not installed",
-        indata=delta)
+        not_installed_msg="pristine-tar is not installed")
+
+
+def _write_pristine_delta(uuencoded, path):
+    """Decode a base64 encoded pristine-tar delta in to a file.
+
+    :param uuencoded: The delta, as stored in the revision properties
+    :param path: Path of the file to write the delta to
+    """
+    # Decode in chunks so that the whole decoded delta never has to be held
+    # in memory next to the encoded one.
+    with open(path, 'wb') as f:
+        pending = ""
+        for i in range(0, len(uuencoded), DELTA_CHUNK_SIZE):
+            chunk = pending + "".join(
+                uuencoded[i:i + DELTA_CHUNK_SIZE].split())
+            # Only complete groups of four characters can be decoded on
+            # their own; carry the rest over to the next chunk.
+            end = len(chunk) - len(chunk) % 4
+            f.write(binascii.a2b_base64(chunk[:end]))
+            pending = chunk[end:]
+        if pending:
+            f.write(binascii.a2b_base64(pending))
 
 
 def extract_upstream_tarball(branch, package, version, dest_dir):
@@ -89,32 +123,43 @@ def extract_upstream_tarball(branch, package, version, dest_dir):
             break
     else:
         raise errors.NoSuchTag(tag_names[0])
-    tree = branch.repository.revision_tree(revid)
+    # Only the revision properties are needed to pick between the two export
+    # strategies, so look up the revision tree once that is settled.
     rev = branch.repository.get_revision(revid)
-    if 'deb-pristine-delta' in rev.properties:
-        uuencoded = rev.properties['deb-pristine-delta']
-        dest_filename = "%s_%s.orig.tar.gz" % (package, version)
-    elif 'deb-pristine-delta-bz2' in rev.properties:
-        uuencoded = rev.properties['deb-pristine-delta-bz2']
-        dest_filename = "%s_%s.orig.tar.bz2" % (package, version)
-    else:
-        uuencoded = None
-    if uuencoded is not None:
-        delta = standard_b64decode(uuencoded)
-        dest = os.path.join(dest_dir, "orig")
-        try:
-            _mod_export.export(tree, dest, format='dir')
-            reconstruct_pristine_tar(
-                dest, delta, os.path.join(dest_dir, dest_filename))
-        finally:
-            if os.path.exists(dest):
-                shutil.rmtree(dest)
+    properties = rev.properties
+    for property_name, compression in PRISTINE_DELTA_PROPERTIES:
+        uuencoded = properties.get(property_name)
+        if uuencoded is not None:
+            break
     else:
         # Default to .tar.gz
-        dest_filename = "%s_%s.orig.tar.gz" % (package, version)
+        compression = "gz"
+    dest_filename = "%s_%s.orig.tar.%s" % (package, version, compression)
+    if uuencoded is None:
+        # Exported straight to its final location; no scratch directory is
+        # needed.
+        tree = branch.repository.revision_tree(revid)
         _mod_export.export(
             tree, os.path.join(dest_dir, dest_filename),
             per_file_timestamps=True)
+        return
+    tree = branch.repository.revision_tree(revid)
+    # The exported tree and the delta (which is handed to pristine-tar as a
+    # file rather than fed through a pipe) share one scratch directory, so
+    # that they are cleaned up together.
+    with tempfile.TemporaryDirectory(
+            prefix="bzr-builder-", dir=dest_dir) as scratch_dir:
+        dest = os.path.join(scratch_dir, "orig")
+        delta_path = os.path.join(scratch_dir, "delta")
+        # Decoding the delta doesn't depend on the exported tree, so do it
+        # in the background while the export runs.
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            decoded = executor.submit(
+                _write_pristine_delta, uuencoded, delta_path)
+            _mod_export.export(tree, dest, format='dir')
+            decoded.result()
+        reconstruct_pristine_tar(
+            dest, delta_path, os.path.join(dest_dir, dest_filename))
 
 
 def add_autobuild_changelog_entry(
@@ -234,7 +279,9 @@ def _run_command(
     # Hide output if -q is in use.
     quiet = trace.is_quiet()
     if quiet:
-        kwargs = {"stderr": subprocess.STDOUT, "stdout": subprocess.PIPE}
+        # Keep stderr apart from stdout, so that the error report can say
+        # which is which.
+        kwargs = {"stderr": subprocess.PIPE, "stdout": subprocess.PIPE}
     else:
         kwargs = {}
     if env is not None:
@@ -242,7 +289,7 @@ def _run_command(
     trace.mutter("running: %r", command)
     try:
         proc = subprocess.Popen(
-            command, cwd=basedir, stdin=subprocess.PIPE,
+            command, cwd=basedir, stdin=subprocess.PIPE, close_fds=True,
             preexec_fn=subprocess_setup, **kwargs)
     except OSError as e:
         if e.errno != errno.ENOENT:
@@ -250,12 +297,15 @@ def _run_command(
         if not_installed_msg is None:
             raise
         raise MissingDependency(msg=not_installed_msg)
-    output = proc.communicate(indata)
+    (stdout, stderr) = proc.communicate(indata)
     if success_exit_codes is None:
         success_exit_codes = [0]
     if proc.returncode not in success_exit_codes:
         if quiet:
-            raise errors.BzrCommandError("%s: %s" % (error_msg, output))
+            encoding = osutils.get_user_encoding()
+            raise errors.BzrCommandError("%s:\n%s%s" % (
+                error_msg, stdout.decode(encoding, "replace"),
+                stderr.decode(encoding, "replace")))
         else:
             raise errors.BzrCommandError(error_msg)
 
@@ -159,7 +159,8 @@ def substitute_branch_vars(base_branch, branch_name, branch, revid):
     :param branch: Branch object for the branch
     :param revid: Revision id in the branch for which to return the revno
     """
-    if base_branch.deb_version is None:
+    if base_branch.deb_version is None or "{" not in base_branch.deb_version:
+        # Nothing is left to substitute.
         return
     revno_var = RevnoVariable(branch_name, branch, revid)
     base_branch.deb_version = revno_var.replace(base_branch.deb_version)
@@ -176,6 +177,10 @@ def substitute_branch_vars(base_branch, branch_name, branch, revid):
     base_branch.deb_version = revdate_var.replace(base_branch.deb_version)
     revtime_var = RevtimeVariable(branch_name, branch, revid)
     base_branch.deb_version = revtime_var.replace(base_branch.deb_version)
+    if not any(var_kls.determine_name(branch_name) in base_branch.deb_version
+               for var_kls in deb_branch_vars):
+        # Don't read the changelog unless it will be used.
+        return
     tree = branch.repository.revision_tree(revid)
     if tree.has_filename('debian/changelog'):
         with tree.lock_read():
@@ -16,6 +16,7 @@
 """Subcommands provided by bzr-builder."""
 
 from io import StringIO
+import os
 
 from breezy import (
     errors,
@@ -33,6 +34,25 @@ from .recipe import (
 import breezy.plugins.launchpad  # noqa: F401
 
 
+def get_parallel_workers():
+    """Return how many branches to open at once, or None for one at a time.
+
+    This is set with the BZR_BUILDER_PARALLEL environment variable.
+    """
+    value = os.environ.get("BZR_BUILDER_PARALLEL")
+    if not value:
+        return None
+    try:
+        workers = int(value)
+    except ValueError:
+        raise errors.BzrCommandError(
+            "BZR_BUILDER_PARALLEL should be a number of branches, not %r"
+            % (value,))
+    if workers < 2:
+        return None
+    return workers
+
+
 def write_manifest_to_transport(
         location, base_branch, possible_transports=None):
     """Write a manifest to disk.
@@ -45,7 +65,11 @@ def write_manifest_to_transport(
     base_transport = child_transport.clone('..')
     base_transport.create_prefix()
     basename = base_transport.relpath(child_transport.base)
-    base_transport.put_bytes(basename, str(base_branch).encode())
+    # Re-parsing the manifest as a sanity check costs as much as parsing
+    # the recipe did, so it is only done on request.
+    validate = bool(os.environ.get("BZR_BUILDER_VERIFY_MANIFEST"))
+    manifest = base_branch.get_recipe_text(validate=validate)
+    base_transport.put_bytes(basename, manifest.encode())
 
 
 def get_branch_from_recipe_location(
@@ -111,8 +135,8 @@ def get_recipe_from_launchpad(username, recipe_name, location):
     :param location: Original location (used for error reporting)
     :return: Text of the recipe
     """
-    from launchpadlib.launchpad import Launchpad
-    lp = Launchpad.login_with("bzr-builder", "production")
+    from .ppa import get_lp
+    lp = get_lp()
     try:
         person = lp.people[username]
     except KeyError:
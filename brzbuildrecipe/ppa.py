@@ -23,8 +23,26 @@ from breezy import (
 from launchpadlib.launchpad import Launchpad
 
 
+# The Launchpad connection, once logged in.
+_launchpad = None
+
+# Seconds to wait between polls of a build; the wait doubles each time
+# nothing has changed, up to POLL_MAX_INTERVAL. That is also the longest a
+# finished build can go unnoticed.
+POLL_INTERVAL = 60
+POLL_MAX_INTERVAL = 300
+
+
 def get_lp():
-    return Launchpad.login_with('bzr-builder', 'production')
+    """Return a Launchpad connection, logging in on first use.
+
+    Logging in resolves and reads the cached credentials, so the
+    connection is kept for the lifetime of the process.
+    """
+    global _launchpad
+    if _launchpad is None:
+        _launchpad = Launchpad.login_with('bzr-builder', 'production')
+    return _launchpad
 
 
 def watch(owner_name, archive_name, package_name, version):
@@ -45,6 +63,8 @@ def watch(owner_name, archive_name, package_name, version):
         "Waiting for version %s of %s to build." % (
             version, package_name))
     start = time.time()
+    interval = POLL_INTERVAL
+    last_state = None
     while True:
         sourceRecords = list(archive.getPublishedSources(
             source_name=package_name, version=version))
@@ -57,35 +77,42 @@ def watch(owner_name, archive_name, package_name, version):
                         owner_name, archive_name, package_name, version))
                 return False
             trace.note("Source not available yet - waiting.")
-            time.sleep(60)
+            time.sleep(POLL_INTERVAL)
             continue
         pkg = sourceRecords[0]
         if pkg.status.lower() not in ('published', 'pending'):
             trace.note("Package status: %s" % (pkg.status,))
-            time.sleep(60)
-            continue
-        # FIXME: LP should export this as an attribute.
-        source_id = pkg.self_link.rsplit('/', 1)[1]
-        buildSummaries = archive.getBuildSummariesForSourceIds(
-            source_ids=[source_id])[source_id]
-        if buildSummaries['status'] in end_states:
-            break
-        if buildSummaries['status'] == 'NEEDSBUILD':
-            # We ignore non-virtual PPA architectures that are sparsely
-            # supplied with buildds.
-            missing = []
-            for build in buildSummaries['builds']:
-                arch = build['arch_tag']
-                if arch in important_arches:
-                    missing.append(arch)
-            if not missing:
-                break
-            extra = ' on ' + ', '.join(missing)
+            state = pkg.status
         else:
-            extra = ''
-        trace.note("%s is still in %s%s" % (
-            pkg.display_name, buildSummaries['status'], extra))
-        time.sleep(60)
+            # FIXME: LP should export this as an attribute.
+            source_id = pkg.self_link.rsplit('/', 1)[1]
+            buildSummaries = archive.getBuildSummariesForSourceIds(
+                source_ids=[source_id])[source_id]
+            if buildSummaries['status'] in end_states:
+                break
+            if buildSummaries['status'] == 'NEEDSBUILD':
+                # We ignore non-virtual PPA architectures that are sparsely
+                # supplied with buildds.
+                missing = []
+                for build in buildSummaries['builds']:
+                    arch = build['arch_tag']
+                    if arch in important_arches:
+                        missing.append(arch)
+                if not missing:
+                    break
+                extra = ' on ' + ', '.join(missing)
+            else:
+                extra = ''
+            trace.note("%s is still in %s%s" % (
+                pkg.display_name, buildSummaries['status'], extra))
+            state = (buildSummaries['status'], extra)
+        # Back off while nothing is happening, but poll promptly again once
+        # the build moves on to a new state.
+        if state != last_state:
+            interval = POLL_INTERVAL
+            last_state = state
+        time.sleep(interval)
+        interval = min(interval * 2, POLL_MAX_INTERVAL)
     trace.note("%s is now %s" % (pkg.display_name, buildSummaries['status']))
     result = True
     if pkg.status.lower() != 'published':
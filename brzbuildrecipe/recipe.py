@@ -13,8 +13,12 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import division
-from functools import partial
+from concurrent import futures
+from contextlib import ExitStack
+from functools import (
+    lru_cache,
+    partial,
+    )
 import os
 import signal
 import subprocess
@@ -24,6 +28,7 @@ from breezy import (
     branch as _mod_branch,
     controldir,
     errors,
+    lazy_regex,
     merge,
     revision,
     revisionspec,
@@ -161,24 +166,22 @@ class RevnoVariable(RevisionVariable):
     minimum_format = 0.1
 
     def get_revno(self):
+        # This tries the mainline and any cached revnos before falling back
+        # to the full revno map, and a remote branch can look it up on the
+        # server side.
         try:
-            revno = self.branch.revision_id_to_revno(self.revid)
-            return str(revno)
+            revno = self.branch.revision_id_to_dotted_revno(self.revid)
         except errors.NoSuchRevision:
-            # We need to load and use the full revno map after all
-            result = self.branch.get_revision_id_to_revno_map().get(
-                    self.revid)
-        if result is None:
-            return result
-        return ".".join(result)
+            return None
+        return ".".join(str(n) for n in revno)
 
     def get(self):
         revno = self.get_revno()
         if revno is None:
             raise errors.BzrCommandError(
                 "Can't substitute revno of "
-                "branch %s in deb-version, as it's revno can't be "
-                "determined" % revno)
+                "branch %s in deb-version, as its revno can't be "
+                "determined" % (self.branch_name or self.branch.base))
         return revno
 
 
@@ -309,6 +312,147 @@ class CommandFailedError(errors.BzrError):
         self.command = command
 
 
+class BranchCache(object):
+    """The branches opened while resolving or building a recipe.
+
+    Branches are keyed by URL, so a branch that the recipe refers to more
+    than once is only opened once. Each branch is read locked when it is
+    opened and stays locked until the cache is closed. While it is locked
+    the branch itself caches its last revision, revision history, revno map
+    and tags, so looking those up again for the same URL doesn't go back to
+    the branch's storage or server.
+
+    The revisions that revspecs resolve to are cached too, keyed by URL and
+    revspec, so branches in a recipe that use the same branch at the same
+    revspec all get the same revision without resolving it again.
+    """
+
+    def __init__(self, possible_transports=None):
+        """Create a BranchCache.
+
+        :param possible_transports: A list of transports that can be reused
+            when opening branches, or None.
+        """
+        self.possible_transports = possible_transports
+        self._branches = {}
+        self._revids = {}
+
+    def _open(self, url, possible_transports):
+        br = _mod_branch.Branch.open(
+            url, possible_transports=possible_transports)
+        br.lock_read()
+        return br
+
+    def open(self, url):
+        """Return the read locked branch at url, opening it if needed."""
+        br = self._branches.get(url)
+        if br is None:
+            br = self._open(url, self.possible_transports)
+            self._branches[url] = br
+        return br
+
+    def revision_id(self, url, revspec):
+        """Return the revision that revspec resolves to in the branch at url.
+
+        :param url: the URL of the branch.
+        :param revspec: the revspec to resolve, or None for the last
+            revision of the branch.
+        """
+        key = (url, revspec)
+        revid = self._revids.get(key)
+        if revid is None:
+            br = self.open(url)
+            if revspec is not None:
+                revid = _parse_revspec(revspec).as_revision_id(br)
+            else:
+                revid = br.last_revision()
+            self._revids[key] = revid
+        return revid
+
+    def prefetch(self, urls, max_workers):
+        """Open the branches at urls in parallel.
+
+        Opening a remote branch is mostly spent waiting on the network, so
+        this overlaps those waits. Branches that fail to open are skipped,
+        so that the error is raised by the later call to open() instead.
+
+        Breezy's lazy imports and format registries aren't thread-safe, so
+        branches are opened one at a time until one has opened, loading
+        those, before any threads are started.
+
+        Connections can't be shared between threads, so each branch is
+        opened with its own list of transports. The transports it connected
+        are only added to possible_transports once all the workers are done.
+
+        :param urls: the URLs of the branches to open.
+        :param max_workers: the most branches to open at once.
+        """
+        remaining = []
+        for url in urls:
+            if url not in self._branches and url not in remaining:
+                remaining.append(url)
+        while remaining:
+            try:
+                self.open(remaining.pop(0))
+            except Exception:
+                continue
+            break
+        urls = set(remaining)
+        if not urls:
+            return
+        transports = {url: [] for url in urls}
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {
+                url: executor.submit(self._open, url, transports[url])
+                for url in urls}
+        for url, future in pending.items():
+            if future.exception() is None:
+                self._branches[url] = future.result()
+            if self.possible_transports is not None:
+                for t in transports[url]:
+                    if t not in self.possible_transports:
+                        self.possible_transports.append(t)
+
+    def close(self):
+        """Unlock and forget all the branches that were opened."""
+        branches = list(self._branches.values())
+        self._branches.clear()
+        self._revids.clear()
+        for br in branches:
+            br.unlock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+@lru_cache(maxsize=128)
+def _parse_revspec(revspec):
+    # RevisionSpecs don't hold on to the branch they are resolved against,
+    # so the same one can be shared by every use of the revspec string. A
+    # recipe only uses a handful, so keep the cache small rather than let
+    # it grow for as long as the process lives.
+    return revisionspec.RevisionSpec.from_string(revspec)
+
+
+def _open_branch(url, branch_cache=None, possible_transports=None):
+    if branch_cache is not None:
+        return branch_cache.open(url)
+    return _mod_branch.Branch.open(
+        url, possible_transports=possible_transports)
+
+
+def _resolve_revision_id(recipe_branch, branch_cache=None):
+    if branch_cache is not None:
+        recipe_branch.revid = branch_cache.revision_id(
+            recipe_branch.url, recipe_branch.revspec)
+    else:
+        recipe_branch.resolve_revision_id()
+
+
 def ensure_basedir(to_transport):
     """Ensure that the basedir of to_transport exists.
 
@@ -326,9 +470,15 @@ def ensure_basedir(to_transport):
                                      % to_transport.base)
 
 
+def _is_checkout(tree):
+    """Return True if tree is a checkout of a branch stored elsewhere."""
+    return (tree.branch.controldir.root_transport.base
+            != tree.controldir.root_transport.base)
+
+
 def pull_or_branch(
         tree_to, br_to, br_from, to_transport, revision_id,
-        accelerator_tree=None, possible_transports=None):
+        accelerator_tree=None, possible_transports=None, lightweight=False):
     """Either pull or branch from a branch.
 
     Depending on whether the target branch and tree exist already this
@@ -337,7 +487,8 @@ def pull_or_branch(
     after creating either if necessary.
 
     :param tree_to: The WorkingTree to pull in to, or None. If not None then
-            br_to must not be None.
+            br_to must not be None. If it is a lightweight checkout then only
+            the tree is updated, and br_to must only be read locked.
     :param br_to: The Branch to pull in to, or None to branch.
     :param br_from: The Branch to pull/branch from.
     :param to_transport: A Transport for the root of the target.
@@ -346,11 +497,27 @@ def pull_or_branch(
             extracting from br_from, or None.
     :param possible_transports: A list of transports that can be reused, or
             None.
+    :param lightweight: If True and br_to is None, create a lightweight
+            checkout of br_from rather than a new branch. The returned branch
+            is then br_from's, so it is only read locked and must not be
+            committed to.
     :return: A tuple of (target tree, target branch) which are the updated
             tree and branch, created if necessary. They are locked, and you
             should use these instead of tree_to and br_to if they were passed
             in, including for unlocking.
     """
+    if br_to is None and lightweight:
+        ensure_basedir(to_transport)
+        tree_to = br_from.create_checkout(
+            to_transport.base, revision_id=revision_id, lightweight=True,
+            accelerator_tree=accelerator_tree)
+        with ExitStack() as stack:
+            tree_to.lock_tree_write()
+            stack.callback(tree_to.unlock)
+            br_to = tree_to.branch
+            br_to.lock_read()
+            stack.pop_all()
+        return tree_to, br_to
     created_tree_to = False
     created_br_to = False
     if br_to is None:
@@ -370,11 +537,30 @@ def pull_or_branch(
             tree_to = dir.create_workingtree()
         br_to = tree_to.branch
         created_br_to = True
-        br_from.tags.merge_to(br_to.tags)
+        # Sprouting has already copied br_from's tags, so they aren't merged
+        # again here.
         created_tree_to = True
     else:
         # We do a "pull"
-        if tree_to is not None:
+        # The branch of a lightweight checkout left by an earlier build is
+        # the one it was made from, so only the tree is moved for those.
+        checkout = tree_to is not None and _is_checkout(tree_to)
+        if checkout and tree_to.branch.base != br_from.base:
+            raise errors.BzrCommandError(
+                "%s is a checkout of %s rather than %s. Build in to a new "
+                "directory instead." % (
+                    tree_to.basedir, tree_to.branch.base, br_from.base))
+        if (tree_to is not None
+                and tree_to.last_revision() == revision_id
+                and (checkout or br_to.last_revision() == revision_id)):
+            # Already up to date, e.g. rebuilding against an unchanged
+            # branch, so only the tags could have changed.
+            if not checkout:
+                br_from.tags.merge_to(br_to.tags)
+        elif checkout:
+            tree_to.update(
+                revision=revision_id, possible_transports=possible_transports)
+        elif tree_to is not None:
             # FIXME: should these pulls overwrite?
             tree_to.pull(
                 br_from, stop_revision=revision_id,
@@ -390,56 +576,50 @@ def pull_or_branch(
             br_to = tree_to.branch
             br_to.lock_write()
             created_tree_to = True
-    if created_tree_to:
-        tree_to.lock_write()
-    try:
+    with ExitStack() as stack:
+        if created_tree_to:
+            tree_to.lock_write()
+            stack.callback(tree_to.unlock)
         if created_br_to:
             br_to.lock_write()
-        try:
-            conflicts = tree_to.conflicts()
-            if len(conflicts) > 0:
-                # FIXME: better reporting
-                raise errors.BzrCommandError("Conflicts... aborting.")
-        except BaseException:
-            if created_br_to:
-                br_to.unlock()
-            raise
-    except BaseException:
-        if created_tree_to:
-            tree_to.unlock()
-        raise
+            stack.callback(br_to.unlock)
+        conflicts = tree_to.conflicts()
+        if len(conflicts) > 0:
+            # FIXME: better reporting
+            raise errors.BzrCommandError("Conflicts... aborting.")
+        # The caller unlocks them from here on.
+        stack.pop_all()
     return tree_to, br_to
 
 
-def merge_branch(child_branch, tree_to, br_to, possible_transports=None):
+def merge_branch(
+        child_branch, tree_to, br_to, possible_transports=None,
+        branch_cache=None):
     """Merge the branch specified by child_branch.
 
     :param child_branch:
         the RecipeBranch to retrieve the branch and revision to merge from.
     :param tree_to: the WorkingTree to merge in to.
     :param br_to: the Branch to merge in to.
+    :param branch_cache: a BranchCache to open the branch through, or None.
+        If resolve_revisions was run with the same BranchCache, the revision
+        it picked is the one that is merged.
     """
-    if child_branch.branch is None:
-        child_branch.branch = _mod_branch.Branch.open(
-            child_branch.url, possible_transports=possible_transports)
+    if branch_cache is not None or child_branch.branch is None:
+        child_branch.branch = _open_branch(
+            child_branch.url, branch_cache, possible_transports)
     with child_branch.branch.lock_read():
         child_branch.branch.tags.merge_to(br_to.tags)
-        if child_branch.revspec is not None:
-            merge_revspec = revisionspec.RevisionSpec.from_string(
-                    child_branch.revspec)
-            try:
-                merge_revid = merge_revspec.as_revision_id(
-                    child_branch.branch)
-            except errors.InvalidRevisionSpec as e:
-                # Give the user a hint if they didn't mean to speciy
-                # a revspec.
-                e.extra = (
-                    ". Did you not mean to specify a revspec "
-                    "at the end of the merge line?")
-                raise e
-        else:
-            merge_revid = child_branch.branch.last_revision()
-        child_branch.revid = merge_revid
+        try:
+            _resolve_revision_id(child_branch, branch_cache)
+        except errors.InvalidRevisionSpec as e:
+            # Give the user a hint if they didn't mean to speciy
+            # a revspec.
+            e.extra = (
+                ". Did you not mean to specify a revspec "
+                "at the end of the merge line?")
+            raise e
+        merge_revid = child_branch.revid
         try:
             merger = merge.Merger.from_revision_ids(
                 tree_to, merge_revid, other_branch=child_branch.branch,
@@ -472,7 +652,8 @@ def merge_branch(child_branch, tree_to, br_to, possible_transports=None):
 
 
 def nest_part_branch(
-        child_branch, tree_to, br_to, subpath, target_subdir=None):
+        child_branch, tree_to, br_to, subpath, target_subdir=None,
+        possible_transports=None, branch_cache=None):
     """Merge the branch subdirectory specified by child_branch.
 
     :param child_branch:
@@ -483,10 +664,15 @@ def nest_part_branch(
         e.g. subpath='/debian' will only merge changes from that directory.
     :param target_subdir: (optional) directory in target to merge that
         subpath into.  Defaults to basename of subpath.
+    :param branch_cache: a BranchCache to open the branch through, or None.
+        If resolve_revisions was run with the same BranchCache, the revision
+        it picked is the one that is merged.
     """
-    child_branch.branch = _mod_branch.Branch.open(child_branch.url)
+    if branch_cache is not None or child_branch.branch is None:
+        child_branch.branch = _open_branch(
+            child_branch.url, branch_cache, possible_transports)
     with child_branch.branch.lock_read():
-        child_branch.resolve_revision_id()
+        _resolve_revision_id(child_branch, branch_cache)
         other_tree = child_branch.branch.basis_tree()
         with other_tree.lock_read():
             if target_subdir is None:
@@ -517,55 +703,68 @@ def nest_part_branch(
 
 
 def update_branch(
-        base_branch, tree_to, br_to, to_transport, possible_transports=None):
-    if base_branch.branch is None:
-        base_branch.branch = _mod_branch.Branch.open(
-            base_branch.url, possible_transports=possible_transports)
+        base_branch, tree_to, br_to, to_transport, possible_transports=None,
+        branch_cache=None, lightweight=False):
+    if branch_cache is not None or base_branch.branch is None:
+        base_branch.branch = _open_branch(
+            base_branch.url, branch_cache, possible_transports)
     with base_branch.branch.lock_read():
-        base_branch.resolve_revision_id()
+        # Through the BranchCache this is the revision resolve_revisions
+        # picked, if it was run with the same one.
+        _resolve_revision_id(base_branch, branch_cache)
         return pull_or_branch(
             tree_to, br_to, base_branch.branch, to_transport,
-            base_branch.revid, possible_transports=possible_transports)
+            base_branch.revid, possible_transports=possible_transports,
+            lightweight=lightweight)
 
 
 def _resolve_revisions_recurse(
-        new_branch, substitute_branch_vars, if_changed_from=None):
+        new_branch, substitute_branch_vars, branch_cache,
+        if_changed_from=None):
     changed = False
-    new_branch.branch = _mod_branch.Branch.open(new_branch.url)
-    with new_branch.branch.lock_read():
-        new_branch.resolve_revision_id()
-        if substitute_branch_vars is not None:
-            substitute_branch_vars(
-                new_branch.name, new_branch.branch, new_branch.revid)
-        if (if_changed_from is not None
-                and (new_branch.revspec is not None
-                     or if_changed_from.revspec is not None)):
-            if if_changed_from.revspec is not None:
-                changed_revspec = revisionspec.RevisionSpec.from_string(
-                        if_changed_from.revspec)
-                changed_revision_id = changed_revspec.as_revision_id(
-                        new_branch.branch)
-            else:
-                changed_revision_id = new_branch.branch.last_revision()
-            if new_branch.revid != changed_revision_id:
+    if if_changed_from is not None and (
+            (new_branch.name, new_branch.url)
+            != (if_changed_from.name, if_changed_from.url)
+            or len(new_branch.child_branches)
+            != len(if_changed_from.child_branches)):
+        # The shape differs, so there are no revisions to compare.
+        changed = True
+        if_changed_from = None
+    new_branch.branch = branch_cache.open(new_branch.url)
+    _resolve_revision_id(new_branch, branch_cache)
+    if substitute_branch_vars is not None:
+        substitute_branch_vars(
+            new_branch.name, new_branch.branch, new_branch.revid)
+    if (if_changed_from is not None
+            and (new_branch.revspec is not None
+                 or if_changed_from.revspec is not None)):
+        changed_revision_id = branch_cache.revision_id(
+            new_branch.url, if_changed_from.revspec)
+        if new_branch.revid != changed_revision_id:
+            changed = True
+    for index, instruction in enumerate(new_branch.child_branches):
+        child_branch = instruction.recipe_branch
+        if_changed_child = None
+        # Once something has changed there is no need to compare further.
+        if if_changed_from is not None and not changed:
+            other_instruction = if_changed_from.child_branches[index]
+            if_changed_child = other_instruction.recipe_branch
+            if (instruction.nest_path != other_instruction.nest_path
+                    or (child_branch is None) != (if_changed_child is None)):
                 changed = True
-        for index, instruction in enumerate(new_branch.child_branches):
-            child_branch = instruction.recipe_branch
-            if_changed_child = None
-            if if_changed_from is not None:
-                if_changed_child = (
-                    if_changed_from.child_branches[index].recipe_branch)
-            if child_branch is not None:
-                child_changed = _resolve_revisions_recurse(
-                    child_branch, substitute_branch_vars,
-                    if_changed_from=if_changed_child)
-                if child_changed:
-                    changed = child_changed
-        return changed
+                if_changed_child = None
+        if child_branch is not None:
+            child_changed = _resolve_revisions_recurse(
+                child_branch, substitute_branch_vars, branch_cache,
+                if_changed_from=if_changed_child)
+            if child_changed:
+                changed = child_changed
+    return changed
 
 
 def resolve_revisions(
-        base_branch, if_changed_from=None, substitute_branch_vars=None):
+        base_branch, if_changed_from=None, substitute_branch_vars=None,
+        branch_cache=None, max_workers=None):
     """Resolve all the unknowns in base_branch.
 
     This walks the RecipeBranch and calls substitute_branch_vars for
@@ -579,32 +778,43 @@ def resolve_revisions(
     :param if_changed_from: the RecipeBranch that we want to compare against.
     :param substitute_branch_vars: Callable called for
         each branch with (name, bzr branch and last revision)
+    :param branch_cache: the BranchCache to open branches through, or None
+        to use one just for this call.
+    :param max_workers: if not None, open the branches of the recipe up to
+        this many at a time before resolving them.
     :return: False if if_changed_from is not None, and the shape and revisions
         of the two branches don't differ. True otherwise.
     """
-    changed = False
-    if if_changed_from is not None:
-        changed = base_branch.different_shape_to(if_changed_from)
-    if_changed_from_revisions = if_changed_from
-    if changed:
-        if_changed_from_revisions = None
-
     if substitute_branch_vars is not None:
         real_subsitute_branch_vars = partial(
             substitute_branch_vars, base_branch)
     else:
         real_subsitute_branch_vars = None
-    changed_revisions = _resolve_revisions_recurse(
-        base_branch, real_subsitute_branch_vars,
-        if_changed_from=if_changed_from_revisions)
-    if not changed:
-        changed = changed_revisions
+
+    def resolve(branch_cache):
+        if max_workers is not None:
+            branch_cache.prefetch(
+                [br.url for br in base_branch.iter_all_branches()],
+                max_workers)
+        # This compares the shape of the recipes as it goes, so that they
+        # are only walked once.
+        return _resolve_revisions_recurse(
+            base_branch, real_subsitute_branch_vars, branch_cache,
+            if_changed_from=if_changed_from)
+
+    if branch_cache is None:
+        with BranchCache() as branch_cache:
+            changed = resolve(branch_cache)
+    else:
+        changed = resolve(branch_cache)
     if if_changed_from is not None and not changed:
         return False
     return True
 
 
-def _build_inner_tree(base_branch, target_path, possible_transports=None):
+def _build_inner_tree(
+        base_branch, target_path, possible_transports=None, branch_cache=None,
+        lightweight=False, nested=False):
     revision_of = ""
     if base_branch.revspec is not None:
         revision_of = "revision '%s' of " % base_branch.revspec
@@ -620,27 +830,51 @@ def _build_inner_tree(base_branch, target_path, possible_transports=None):
     except errors.NotBranchError:
         tree_to = None
         br_to = None
-    if tree_to is not None:
-        tree_to.lock_write()
-    try:
-        if br_to is not None:
-            br_to.lock_write()
-        try:
-            tree_to, br_to = update_branch(
-                base_branch, tree_to, br_to,
-                to_transport, possible_transports=possible_transports)
-            for instruction in base_branch.child_branches:
-                instruction.apply(target_path, tree_to, br_to)
-        finally:
-            # Is this ok if tree_to is created by pull_or_branch?
+    # A lightweight checkout shares the branch it was made from, so only a
+    # nested tree that nothing is merged in to can be one.
+    merged_in_to = any(
+        isinstance(instruction, (MergeInstruction, NestPartInstruction))
+        for instruction in base_branch.child_branches)
+    checkout = lightweight and nested and not merged_in_to
+    existing_checkout = tree_to is not None and _is_checkout(tree_to)
+    if existing_checkout and merged_in_to:
+        raise errors.BzrCommandError(
+            "%s is a lightweight checkout, so nothing can be merged in to it. "
+            "Build in to a new directory instead." % target_path)
+    with ExitStack() as stack:
+        if existing_checkout:
+            # The branch of a lightweight checkout from an earlier build is
+            # the one it was made from, which mustn't be written to.
+            tree_to.lock_tree_write()
+            stack.callback(tree_to.unlock)
+            br_to.lock_read()
+            stack.callback(br_to.unlock)
+        else:
+            if tree_to is not None:
+                tree_to.lock_write()
+                stack.callback(tree_to.unlock)
             if br_to is not None:
-                br_to.unlock()
-    finally:
-        if tree_to is not None:
-            tree_to.unlock()
-
-
-def build_tree(base_branch, target_path, possible_transports=None):
+                br_to.lock_write()
+                stack.callback(br_to.unlock)
+        tree_to, br_to = update_branch(
+            base_branch, tree_to, br_to,
+            to_transport, possible_transports=possible_transports,
+            branch_cache=branch_cache, lightweight=checkout)
+        # update_branch hands back a locked tree and branch, which may not
+        # be the ones that were passed in; those are the ones to unlock.
+        stack.pop_all()
+        stack.callback(tree_to.unlock)
+        stack.callback(br_to.unlock)
+        for instruction in base_branch.child_branches:
+            instruction.apply(
+                target_path, tree_to, br_to,
+                possible_transports=possible_transports,
+                branch_cache=branch_cache, lightweight=lightweight)
+
+
+def build_tree(
+        base_branch, target_path, possible_transports=None, branch_cache=None,
+        lightweight=False, max_workers=None):
     """Build the RecipeBranch at a path.
 
     Follow the instructions embodied in RecipeBranch and build a tree
@@ -650,10 +884,36 @@ def build_tree(base_branch, target_path, possible_transports=None):
 
     :param base_branch: a RecipeBranch to build.
     :param target_path: the path to the base of the desired output.
+    :param branch_cache: the BranchCache to open branches through, or None
+        to use one just for this call.
+    :param lightweight: if True, nested branches that nothing is merged in
+        to are created as lightweight checkouts instead of full branches.
+        Only suitable when target_path is a fresh scratch directory.
+    :param max_workers: if not None, open the branches of the recipe that
+        aren't open yet up to this many at a time before building.
     """
     trace.note("Building tree.")
-    _build_inner_tree(
-        base_branch, target_path, possible_transports=possible_transports)
+    if possible_transports is None:
+        # Share the transports opened for the base tree with the nested
+        # trees and branches, so their connections are reused.
+        possible_transports = []
+
+    def build(branch_cache):
+        if max_workers is not None:
+            branch_cache.prefetch(
+                [br.url for br in base_branch.iter_all_branches()
+                 if br.branch is None],
+                max_workers)
+        _build_inner_tree(
+            base_branch, target_path,
+            possible_transports=possible_transports,
+            branch_cache=branch_cache, lightweight=lightweight)
+
+    if branch_cache is None:
+        with BranchCache(possible_transports) as branch_cache:
+            build(branch_cache)
+    else:
+        build(branch_cache)
 
 
 class ChildBranch(object):
@@ -670,7 +930,9 @@ class ChildBranch(object):
         self.recipe_branch = recipe_branch
         self.nest_path = nest_path
 
-    def apply(self, target_path, tree_to, br_to, possible_transports=None):
+    def apply(
+            self, target_path, tree_to, br_to, possible_transports=None,
+            branch_cache=None, lightweight=False):
         raise NotImplementedError(self.apply)
 
     def as_tuple(self):
@@ -691,7 +953,9 @@ class ChildBranch(object):
 
 class CommandInstruction(ChildBranch):
 
-    def apply(self, target_path, tree_to, br_to, possible_transports=None):
+    def apply(
+            self, target_path, tree_to, br_to, possible_transports=None,
+            branch_cache=None, lightweight=False):
         # it's a command
         trace.note("Running '%s' in '%s'." % (self.nest_path, target_path))
         proc = subprocess.Popen(
@@ -707,7 +971,9 @@ class CommandInstruction(ChildBranch):
 
 class MergeInstruction(ChildBranch):
 
-    def apply(self, target_path, tree_to, br_to, possible_transports=None):
+    def apply(
+            self, target_path, tree_to, br_to, possible_transports=None,
+            branch_cache=None, lightweight=False):
         revision_of = ""
         if self.recipe_branch.revspec is not None:
             revision_of = "revision '%s' of " % self.recipe_branch.revspec
@@ -716,7 +982,8 @@ class MergeInstruction(ChildBranch):
                 revision_of, self.recipe_branch.url, target_path))
         merge_branch(
             self.recipe_branch, tree_to, br_to,
-            possible_transports=possible_transports)
+            possible_transports=possible_transports,
+            branch_cache=branch_cache)
 
     def as_text(self):
         revid_part = self._get_revid_part()
@@ -735,10 +1002,13 @@ class NestPartInstruction(ChildBranch):
         self.subpath = subpath
         self.target_subdir = target_subdir
 
-    def apply(self, target_path, tree_to, br_to):
+    def apply(
+            self, target_path, tree_to, br_to, possible_transports=None,
+            branch_cache=None, lightweight=False):
         nest_part_branch(
             self.recipe_branch, tree_to, br_to, self.subpath,
-            self.target_subdir)
+            self.target_subdir, possible_transports=possible_transports,
+            branch_cache=branch_cache)
 
     def as_text(self):
         revid_part = self._get_revid_part()
@@ -761,11 +1031,14 @@ class NestInstruction(ChildBranch):
 
     can_have_children = True
 
-    def apply(self, target_path, tree_to, br_to, possible_transports=None):
+    def apply(
+            self, target_path, tree_to, br_to, possible_transports=None,
+            branch_cache=None, lightweight=False):
         _build_inner_tree(
             self.recipe_branch,
             target_path=os.path.join(target_path, self.nest_path),
-            possible_transports=possible_transports)
+            possible_transports=possible_transports,
+            branch_cache=branch_cache, lightweight=lightweight, nested=True)
 
     def as_text(self):
         revid_part = self._get_revid_part()
@@ -804,6 +1077,8 @@ class RecipeBranch(object):
         self.url = url
         self.revspec = revspec
         self.child_branches = []
+        # The nest paths used so far, to catch two branches nested at one.
+        self._nest_paths = set()
         self.revid = None
         self.branch = None
 
@@ -811,7 +1086,7 @@ class RecipeBranch(object):
         """Resolve the revision id for this branch.
         """
         if self.revspec is not None:
-            revspec = revisionspec.RevisionSpec.from_string(self.revspec)
+            revspec = _parse_revspec(self.revspec)
             revision_id = revspec.as_revision_id(self.branch)
         else:
             revision_id = self.branch.last_revision()
@@ -843,8 +1118,9 @@ class RecipeBranch(object):
             the relative path at which this branch should be nested.
         :param branch: the RecipeBranch to nest.
         """
-        assert location not in [b.nest_path for b in self.child_branches],\
+        assert location not in self._nest_paths, \
             "%s already has branch nested there" % location
+        self._nest_paths.add(location)
         self.child_branches.append(NestInstruction(branch, location))
 
     def run_command(self, command):
@@ -856,23 +1132,19 @@ class RecipeBranch(object):
 
     def different_shape_to(self, other_branch):
         """Tests whether the name, url and child_branches are the same"""
-        if self.name != other_branch.name:
-            return True
-        if self.url != other_branch.url:
+        if (self.name, self.url) != (other_branch.name, other_branch.url):
             return True
-        if len(self.child_branches) != len(other_branch.child_branches):
+        child_branches = self.child_branches
+        other_child_branches = other_branch.child_branches
+        if len(child_branches) != len(other_child_branches):
             return True
-        for index, instruction in enumerate(self.child_branches):
+        for instruction, other_instruction in zip(
+                child_branches, other_child_branches):
+            if instruction.nest_path != other_instruction.nest_path:
+                return True
             child_branch = instruction.recipe_branch
-            nest_location = instruction.nest_path
-            other_instruction = other_branch.child_branches[index]
             other_child_branch = other_instruction.recipe_branch
-            other_nest_location = other_instruction.nest_path
-            if nest_location != other_nest_location:
-                return True
-            if ((child_branch is None and other_child_branch is not None)
-                    or (child_branch is not None
-                        and other_child_branch is None)):
+            if (child_branch is None) != (other_child_branch is None):
                 return True
             # if child_branch is None then other_child_branch must be
             # None too, meaning that they are both run instructions,
@@ -937,35 +1209,34 @@ class BaseRecipeBranch(RecipeBranch):
         self.deb_version = deb_version
         self.format = format
 
-    def _add_child_branches_to_manifest(self, child_branches, indent_level):
-        manifest = ""
+    def _add_child_branches_to_manifest(
+            self, child_branches, indent_level, lines):
+        indent = "  " * indent_level
         for instruction in child_branches:
-            manifest += "%s%s\n" % (
-                "  " * indent_level, instruction.as_text())
+            lines.append("%s%s\n" % (indent, instruction.as_text()))
             if instruction.can_have_children:
-                manifest += self._add_child_branches_to_manifest(
+                self._add_child_branches_to_manifest(
                     instruction.recipe_branch.child_branches,
-                    indent_level+1)
-        return manifest
+                    indent_level+1, lines)
 
     def __str__(self):
         return self.get_recipe_text(validate=True)
 
     def get_recipe_text(self, validate=False):
-        manifest = "# bzr-builder format %s" % str(self.format)
+        header = "# bzr-builder format %s" % str(self.format)
         if self.deb_version is not None:
             # TODO: should we store the expanded version that was used?
-            manifest += " deb-version %s" % (self.deb_version,)
-        manifest += "\n"
+            header += " deb-version %s" % (self.deb_version,)
+        lines = [header + "\n"]
         if self.revid is not None:
-            manifest += "%s revid:%s\n" % (
-                self.url, self.revid.decode('utf-8'))
+            lines.append("%s revid:%s\n" % (
+                self.url, self.revid.decode('utf-8')))
         elif self.revspec is not None:
-            manifest += "%s %s\n" % (self.url, self.revspec)
+            lines.append("%s %s\n" % (self.url, self.revspec))
         else:
-            manifest += "%s\n" % (self.url,)
-        manifest += self._add_child_branches_to_manifest(
-            self.child_branches, 0)
+            lines.append("%s\n" % (self.url,))
+        self._add_child_branches_to_manifest(self.child_branches, 0, lines)
+        manifest = "".join(lines)
         if validate:
             # Sanity check.
             # TODO: write a function that compares the result of this parse
@@ -997,15 +1268,21 @@ class ForbiddenInstructionError(RecipeParseError):
         self.instruction_name = instruction_name
 
 
+# Patterns used by RecipeParser to scan a run of characters in one go.
+whitespace_re = lazy_regex.lazy_compile(r"[ \t]*")
+to_whitespace_re = lazy_regex.lazy_compile(r"[^ \t]*")
+integer_re = lazy_regex.lazy_compile(r"[0-9]*")
+float_re = lazy_regex.lazy_compile(r"[0-9]+(\.[0-9]*)?")
+
+
 class RecipeParser(object):
     """Parse a recipe.
 
     The parse() method is probably the only one that interests you.
     """
 
-    whitespace_chars = " \t"
+    whitespace_chars = frozenset(" \t")
     eol_char = "\n"
-    digit_chars = ("0", "1", "2", "3", "4", "5", "6", "7", "8", "9")
 
     NEWEST_VERSION = 0.4
 
@@ -1017,10 +1294,10 @@ class RecipeParser(object):
         :param filename: the filename of the recipe if known (for error
             reporting).
         """
-        if getattr(f, "read", None) is not None:
-            self.text = f.read()
-        else:
+        if isinstance(f, str):
             self.text = f
+        else:
+            self.text = f.read()
         self.filename = filename
         if filename is None:
             self.filename = "recipe"
@@ -1033,25 +1310,25 @@ class RecipeParser(object):
         :type permitted_instructions: list(str) or None
         :return: a RecipeBranch representing the recipe.
         """
-        self.lines = self.text.split("\n")
         self.index = 0
         self.line_index = 0
-        self.current_line = self.lines[self.line_index]
+        self.next_line_start = 0
+        self.read_line()
         self.current_indent_level = 0
         self.seen_nicks = set()
         self.seen_paths = {".": 1}
         (version, deb_version) = self.parse_header()
         self.version = version
         last_instruction = None
+        # A stack of the RecipeBranches that the current indent level is
+        # nested in, with the one that instructions apply to on top.
         active_branches = []
         last_branch = None
-        while self.line_index < len(self.lines):
-            if self.is_blankline():
-                self.new_line()
-                continue
-            comment = self.parse_comment_line()
-            if comment is not None:
-                self.new_line()
+        while self.current_line is not None:
+            # This also takes blank lines, as empty comments. Neither has
+            # anything left on it for new_line() to check.
+            if self.parse_comment_line() is not None:
+                self.skip_line()
                 continue
             old_indent_level = self.parse_indent()
             if old_indent_level is not None:
@@ -1064,7 +1341,7 @@ class RecipeParser(object):
                     active_branches.append(last_branch)
                 else:
                     unindent = self.current_indent_level - old_indent_level
-                    active_branches = active_branches[:unindent]
+                    del active_branches[unindent:]
             if last_instruction is None:
                 url = self.take_to_whitespace("branch to start from")
                 revspec = self.parse_optional_revspec()
@@ -1118,7 +1395,7 @@ class RecipeParser(object):
         version, version_str = self.peek_float("format version")
         if version > self.NEWEST_VERSION:
             self.throw_parse_error("Unknown format: '%s'" % str(version))
-        self.take_chars(len(version_str))
+        self.index += len(version_str)
         deb_version = self.parse_optional_deb_version()
         self.new_line()
         return version, deb_version
@@ -1146,7 +1423,7 @@ class RecipeParser(object):
                         "The '%s' instruction is forbidden" % instruction,
                         cls=ForbiddenInstructionError,
                         instruction_name=instruction)
-            self.take_chars(len(instruction))
+            self.index += len(instruction)
             return instruction
         self.throw_parse_error(
             "Expecting %s, got '%s'" % (options_str, instruction))
@@ -1162,14 +1439,12 @@ class RecipeParser(object):
         if branch_id in self.seen_nicks:
             self.throw_parse_error(
                 "'%s' was already used to identify a branch." % branch_id)
-        self.take_chars(len(branch_id))
+        self.index += len(branch_id)
         self.seen_nicks.add(branch_id)
         return branch_id
 
     def parse_branch_url(self, instruction):
-        self.parse_whitespace("the branch url", instruction=instruction)
-        branch_url = self.take_to_whitespace("the branch url", instruction)
-        return branch_url
+        return self.take_token("the branch url", instruction)
 
     def parse_branch_location(self, instruction):
         # FIXME: Needs a better term
@@ -1196,19 +1471,15 @@ class RecipeParser(object):
                 "Paths outside the current directory "
                 "are not allowed: %s" % location,
                 cls=InstructionParseError, instruction=instruction)
-        self.take_chars(len(location))
+        self.index += len(location)
         self.seen_paths[norm_location] = self.line_index + 1
         return location
 
     def parse_subpath(self, instruction):
-        self.parse_whitespace("the subpath to merge", instruction=instruction)
-        location = self.take_to_whitespace("the subpath to merge", instruction)
-        return location
+        return self.take_token("the subpath to merge", instruction)
 
     def parse_revspec(self):
-        self.parse_whitespace("the revspec")
-        revspec = self.take_to_whitespace("the revspec")
-        return revspec
+        return self.take_token("the revspec")
 
     def parse_optional_deb_version(self):
         self.parse_whitespace("'deb-version'", require=False)
@@ -1218,23 +1489,15 @@ class RecipeParser(object):
             return None
         if actual != "deb-version":
             self.throw_expecting_error("deb-version", actual)
-        self.take_chars(len("deb-version"))
+        self.index += len("deb-version")
         self.parse_whitespace("a value for 'deb-version'")
         return self.take_to_whitespace("a value for 'deb-version'")
 
     def parse_optional_revspec(self):
-        self.parse_whitespace(None, require=False)
-        revspec = self.peek_to_whitespace()
-        if revspec is not None:
-            self.take_chars(len(revspec))
-        return revspec
+        return self.take_optional_token()
 
     def parse_optional_path(self):
-        self.parse_whitespace(None, require=False)
-        path = self.peek_to_whitespace()
-        if path is not None:
-            self.take_chars(len(path))
-        return path
+        return self.take_optional_token()
 
     def throw_parse_error(self, problem, cls=None, **kwargs):
         if cls is None:
@@ -1263,36 +1526,41 @@ class RecipeParser(object):
             self.throw_parse_error(
                 "Expecting the end of the line, got '%s'"
                 % remaining, **kwargs)
+        self.skip_line()
+
+    def skip_line(self):
+        """Move on to the start of the next line, ignoring what is left."""
         self.index = 0
         self.line_index += 1
-        if self.line_index >= len(self.lines):
-            self.current_line = None
-        else:
-            self.current_line = self.lines[self.line_index]
+        self.read_line()
 
-    def is_blankline(self):
-        whitespace = self.peek_whitespace()
-        if whitespace is None:
-            return True
-        return self.peek_char(skip=len(whitespace)) is None
+    def read_line(self):
+        """Make the next line of the text the current line.
+
+        The lines are found as the parser gets to them rather than by
+        splitting the whole text up front. current_line is set to None
+        once there are no lines left.
+        """
+        start = self.next_line_start
+        if start > len(self.text):
+            self.current_line = None
+            self.line_length = 0
+            return
+        end = self.text.find(self.eol_char, start)
+        if end == -1:
+            end = len(self.text)
+        self.current_line = self.text[start:end]
+        self.line_length = end - start
+        self.next_line_start = end + 1
 
     def take_char(self):
-        if self.index >= len(self.current_line):
+        if self.index >= self.line_length:
             return None
         self.index += 1
         return self.current_line[self.index-1]
 
-    def take_chars(self, num):
-        ret = ""
-        for i in range(num):
-            char = self.take_char()
-            if char is None:
-                return None
-            ret += char
-        return ret
-
     def peek_char(self, skip=0):
-        if self.index + skip >= len(self.current_line):
+        if self.index + skip >= self.line_length:
             return None
         return self.current_line[self.index + skip]
 
@@ -1315,9 +1583,10 @@ class RecipeParser(object):
         # -> "oh, you aren't allowed to indent at that point anyway"
         if "\t" in new_indent:
             self.throw_parse_error("Indents may not be done by tabs")
-        if (len(new_indent) % 2 != 0):
+        indent_width = len(new_indent)
+        if indent_width & 1:
             self.throw_parse_error("Indent not a multiple of two spaces")
-        new_indent_level = len(new_indent) // 2
+        new_indent_level = indent_width >> 1
         if new_indent_level != self.current_indent_level:
             old_indent_level = self.current_indent_level
             self.current_indent_level = new_indent_level
@@ -1330,8 +1599,7 @@ class RecipeParser(object):
 
     def parse_whitespace(self, looking_for, require=True, instruction=None):
         if require:
-            actual = self.peek_char()
-            if actual is None:
+            if self.index >= self.line_length:
                 kwargs = {}
                 if instruction is not None:
                     kwargs = {
@@ -1341,52 +1609,37 @@ class RecipeParser(object):
                 self.throw_parse_error(
                     "End of line while looking for %s" % looking_for,
                     **kwargs)
+            actual = self.current_line[self.index]
             if actual not in self.whitespace_chars:
                 self.throw_parse_error(
                     "Expecting whitespace before %s, got '%s'." %
                     (looking_for, actual))
-        ret = ""
-        actual = self.peek_char()
-        while (actual is not None and actual in self.whitespace_chars):
-            self.take_char()
-            ret += actual
-            actual = self.peek_char()
-        return ret
+        match = whitespace_re.match(self.current_line, self.index)
+        self.index = match.end()
+        return match.group()
 
     def peek_whitespace(self):
-        ret = ""
-        char = self.peek_char()
-        if char is None:
-            return char
-        count = 0
-        while char is not None and char in self.whitespace_chars:
-            ret += char
-            count += 1
-            char = self.peek_char(skip=count)
-        return ret
+        if self.peek_char() is None:
+            return None
+        return whitespace_re.match(self.current_line, self.index).group()
 
     def parse_word(self, expected, require_whitespace=True):
         self.parse_whitespace("'%s'" % expected, require=require_whitespace)
-        length = len(expected)
-        actual = self.peek_to_whitespace()
-        if actual == expected:
-            self.take_chars(length)
+        line = self.current_line
+        end = self.index + len(expected)
+        if (line.startswith(expected, self.index)
+                and (end == len(line) or line[end] in self.whitespace_chars)):
+            self.index = end
             return expected
+        actual = self.peek_to_whitespace()
         if actual is None:
             self.throw_eol(expected)
         self.throw_expecting_error(expected, actual)
 
     def peek_to_whitespace(self):
-        ret = ""
-        char = self.peek_char()
-        if char is None:
-            return char
-        count = 0
-        while char is not None and char not in self.whitespace_chars:
-            ret += char
-            count += 1
-            char = self.peek_char(skip=count)
-        return ret
+        if self.index >= self.line_length:
+            return None
+        return to_whitespace_re.match(self.current_line, self.index).group()
 
     def take_to_whitespace(self, looking_for, instruction=None):
         text = self.peek_to_whitespace()
@@ -1399,47 +1652,48 @@ class RecipeParser(object):
             self.throw_parse_error(
                 "End of line while looking for %s" % looking_for,
                 **kwargs)
-        self.take_chars(len(text))
+        self.index += len(text)
         return text
 
+    def take_optional_token(self):
+        """Take any whitespace and the token after it, or None at the end."""
+        line = self.current_line
+        start = whitespace_re.match(line, self.index).end()
+        if start >= self.line_length:
+            self.index = start
+            return None
+        match = to_whitespace_re.match(line, start)
+        self.index = match.end()
+        return match.group()
+
+    def take_token(self, looking_for, instruction=None):
+        """Take the whitespace and then the token that follows it."""
+        self.parse_whitespace(looking_for, instruction=instruction)
+        return self.take_to_whitespace(looking_for, instruction)
+
     def peek_float(self, looking_for):
         self.parse_whitespace(looking_for)
-        ret = self._parse_integer()
-        conv_fn = int
-        if ret == "":
+        match = float_re.match(self.current_line, self.index)
+        if match is None or match.group().endswith("."):
             self.throw_parse_error(
                 "Expecting a float, got '%s'" % self.peek_to_whitespace())
-        if self.peek_char(skip=len(ret)) == ".":
+        ret = match.group()
+        conv_fn = int
+        if match.group(1) is not None:
             conv_fn = float
-            ret2 = self._parse_integer(skip=len(ret)+1)
-            if ret2 == "":
-                self.throw_parse_error(
-                    "Expecting a float, got '%s'" % self.peek_to_whitespace())
-            ret += "." + ret2
         try:
             fl = conv_fn(ret)
         except ValueError:
             self.throw_parse_error("Expecting a float, got '%s'" % ret)
         return (fl, ret)
 
-    def _parse_integer(self, skip=0):
-        i = skip
-        ret = ""
-        while True:
-            char = self.peek_char(skip=i)
-            if char not in self.digit_chars:
-                break
-            ret += char
-            i = i+1
-        return ret
-
     def parse_integer(self):
-        ret = self._parse_integer()
-        if ret == "":
+        match = integer_re.match(self.current_line, self.index)
+        if match.end() == self.index:
             self.throw_parse_error(
                 "Expected an integer, found %s" % self.peek_to_whitespace())
-        self.take_chars(len(ret))
-        return ret
+        self.index = match.end()
+        return match.group()
 
     def take_to_newline(self):
         text = self.current_line[self.index:]
@@ -1447,14 +1701,11 @@ class RecipeParser(object):
         return text
 
     def parse_comment_line(self):
-        whitespace = self.peek_whitespace()
-        if whitespace is None:
-            return ""
-        if self.peek_char(skip=len(whitespace)) is None:
+        line = self.current_line
+        start = whitespace_re.match(line, self.index).end()
+        if start >= len(line):
             return ""
-        if self.peek_char(skip=len(whitespace)) != "#":
+        if line[start] != "#":
             return None
-        self.parse_whitespace(None, require=False)
-        comment = self.current_line[self.index:]
-        self.index += len(comment)
-        return comment
+        self.index = len(line)
+        return line[start:]
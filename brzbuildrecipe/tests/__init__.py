@@ -35,11 +35,24 @@ class _PristineTarFeature(Feature):
 PristineTarFeature = _PristineTarFeature()
 
 
+class _DebuildFeature(Feature):
+
+    def feature_name(self):
+        return '/usr/bin/debuild'
+
+    def _probe(self):
+        return os.path.exists("/usr/bin/debuild")
+
+
+DebuildFeature = _DebuildFeature()
+
+
 def test_suite():
     loader = TestUtil.TestLoader()
     suite = TestSuite()
     testmod_names = [
             'blackbox',
+            'deb_util',
             'deb_version',
             'recipe',
             ]
@@ -14,11 +14,19 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from base64 import standard_b64encode
+from contextlib import (
+    contextmanager,
+    redirect_stderr,
+    redirect_stdout,
+    )
+import importlib
 import os
 import shlex
+import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 from testtools.content import text_content
 from textwrap import dedent
 
@@ -32,7 +40,9 @@ from breezy.tests import (
     TestCaseWithTransport,
     )
 
+from .. import dailydeb
 from . import (
+    DebuildFeature,
     Feature,
     PristineTarFeature,
     )
@@ -76,25 +86,121 @@ def make_pristine_tar_delta(dest, tarball_path):
     return stdout
 
 
+@contextmanager
+def capture_fd(fd):
+    """Send what is written to a file descriptor to a temporary file.
+
+    Unlike replacing sys.stdout or sys.stderr, this also catches what child
+    processes write.
+
+    :param fd: the file descriptor to capture, e.g. 1 for stdout.
+    :return: a context manager that gives the temporary file.
+    """
+    with tempfile.TemporaryFile() as capture:
+        saved = os.dup(fd)
+        os.dup2(capture.fileno(), fd)
+        try:
+            yield capture
+        finally:
+            os.dup2(saved, fd)
+            os.close(saved)
+
+
 class BlackboxBuilderTests(TestCaseWithTransport):
 
     def _run(self, cmd, args, retcode):
-        cmd = [sys.executable, "-m", "brzbuildrecipe." + cmd]
+        """Run one of the commands in this process.
+
+        This mirrors what running the module as a script does, including
+        turning an exception into an "ERROR: " line and exit code 3, without
+        the cost of starting a new interpreter for every command. Output is
+        captured at the file descriptor level, so that of the tools the
+        command runs is included.
+        """
+        module = importlib.import_module("brzbuildrecipe." + cmd)
         if isinstance(args, str):
-            cmd += shlex.split(args)
-        else:
-            cmd += list(args)
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        stdout, stderr = process.communicate()
+            args = shlex.split(args)
+        self.overrideAttr(sys, "argv", [cmd + ".py"] + list(args))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with capture_fd(1) as out_f, capture_fd(2) as err_f:
+            with open(1, "w", 1, "utf-8", closefd=False) as out, \
+                    open(2, "w", 1, "utf-8", closefd=False) as err, \
+                    redirect_stdout(out), redirect_stderr(err):
+                try:
+                    module.main()
+                except SystemExit as e:
+                    returncode = e.code or 0
+                except Exception as e:
+                    sys.stderr.write('ERROR: %s\n' % e)
+                    returncode = 3
+                else:
+                    returncode = 0
+            out_f.seek(0)
+            stdout = out_f.read().decode("utf-8", "replace")
+            err_f.seek(0)
+            stderr = err_f.read().decode("utf-8", "replace")
         if stdout:
             self.addDetail("stdout", text_content(stdout))
         if stderr:
             self.addDetail("stderr", text_content(stderr))
-        self.assertEqual(retcode, process.returncode)
+        self.assertEqual(retcode, returncode)
         return stdout, stderr
 
+    # Copies of the trees that _make_from_template has built, by the name
+    # of the function that built them and the path they were built at. Each
+    # test class gets its own.
+    _template_dir = None
+    _templates = None
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.__dict__.get("_template_dir") is not None:
+            shutil.rmtree(cls._template_dir)
+            cls._template_dir = None
+            cls._templates = None
+        super(BlackboxBuilderTests, cls).tearDownClass()
+
+    def _make_from_template(self, path, make_tree):
+        """Make a tree at path with make_tree, or copy the one it made.
+
+        Each tree is only built and committed once per test class; later
+        calls copy that tree rather than building and committing it again.
+        The copies therefore have the same revision ids in every test, and
+        whatever the first test to build them had set up, such as the
+        committer, applies to all of them.
+
+        :param path: the path to make the tree at.
+        :param make_tree: a callable taking path that builds the tree there
+            and returns it.
+        :return: the WorkingTree at path.
+        """
+        cls = type(self)
+        if cls.__dict__.get("_templates") is None:
+            cls._template_dir = tempfile.mkdtemp(prefix="brzbuildrecipe-")
+            cls._templates = {}
+        key = (make_tree.__name__, path)
+        template = cls._templates.get(key)
+        if template is not None:
+            osutils.copy_tree(template, path)
+            return workingtree.WorkingTree.open(path)
+        tree = make_tree(path)
+        template = os.path.join(cls._template_dir, str(len(cls._templates)))
+        osutils.copy_tree(path, template)
+        cls._templates[key] = template
+        return tree
+
+    def make_source_with_file(self):
+        """Make a "source" branch with a single committed file, "a"."""
+        return self._make_from_template("source", self._make_source_with_file)
+
+    def _make_source_with_file(self, path):
+        source = self.make_branch_and_tree(path)
+        self.build_tree([os.path.join(path, "a")])
+        source.add(["a"])
+        source.commit("one")
+        return source
+
     def run_build(self, args, retcode=0):
         return self._run("build", args, retcode=retcode)
 
@@ -107,6 +213,14 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         # for the changelog checks.
         self.overrideEnv("DEBEMAIL", "maint@maint.org")
         self.overrideEnv("DEBFULLNAME", "M. Maintainer")
+        # Keep checking that the manifests written can be parsed again.
+        self.overrideEnv("BZR_BUILDER_VERIFY_MANIFEST", "1")
+
+    def skip_source_package_build(self):
+        """Stop dailydeb running debuild, for tests of the tree it makes."""
+        self.overrideAttr(
+            dailydeb, "build_source_package",
+            lambda basedir, tgz_check=True: None)
 
     def _get_file_contents(self, filename, mode="r"):
         """Helper to read contents of a file
@@ -125,7 +239,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             self.assertEqual(
                 'usage: build.py [-h] [--manifest PATH] '
                 '[--revision REVISION]\n'
-                '                [--if-changed-from PATH]\n'
+                '                [--if-changed-from PATH] [--lightweight]\n'
                 '                LOCATION WORKING-BASEDIR\n'
                 'build.py: error: the following arguments are '
                 'required: LOCATION, WORKING-BASEDIR\n',
@@ -134,7 +248,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             self.assertEqual(
                 'usage: build.py [-h] [--manifest PATH] '
                 '[--revision REVISION]\n'
-                '                [--if-changed-from PATH]\n'
+                '                [--if-changed-from PATH] [--lightweight]\n'
                 '                LOCATION WORKING-BASEDIR\n'
                 'build.py: error: too few arguments\n',
                 err)
@@ -145,7 +259,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             self.assertEqual(
                 'usage: build.py [-h] [--manifest PATH] '
                 '[--revision REVISION]\n'
-                '                [--if-changed-from PATH]\n'
+                '                [--if-changed-from PATH] [--lightweight]\n'
                 '                LOCATION WORKING-BASEDIR\n'
                 'build.py: error: the following arguments are required: '
                 'WORKING-BASEDIR\n',
@@ -154,7 +268,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             self.assertEqual(
                 'usage: build.py [-h] [--manifest PATH] '
                 '[--revision REVISION]\n'
-                '                [--if-changed-from PATH]\n'
+                '                [--if-changed-from PATH] [--lightweight]\n'
                 '                LOCATION WORKING-BASEDIR\n'
                 'build.py: error: too few arguments\n',
                 err)
@@ -164,13 +278,27 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertEqual(
             "ERROR: Specified recipe does not exist: recipe\n", err)
 
+    def test_cmd_builder_script(self):
+        # The other tests run main() in this process, so check once that
+        # running the module as a script reports errors the same way.
+        import brzbuildrecipe
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(brzbuildrecipe.__file__))]
+            + [p for p in [env.get("PYTHONPATH")] if p])
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "brzbuildrecipe.build", "recipe",
+             "working"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=env)
+        out, err = proc.communicate()
+        self.assertEqual(3, proc.returncode)
+        self.assertEqual(
+            b"ERROR: Specified recipe does not exist: recipe\n", err)
+
     def test_cmd_builder_simple_recipe(self):
         self.build_tree_contents(
             [("recipe", b"# bzr-builder format 0.1 deb-version 1\nsource\n")])
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.run_build("recipe working")
         self.assertPathExists("working/a")
         tree = workingtree.WorkingTree.open("working")
@@ -182,10 +310,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             % revid)
 
     def test_cmd_builder_simple_branch(self):
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.run_build("source working")
         self.assertPathExists("working/a")
         tree = workingtree.WorkingTree.open("working")
@@ -199,10 +324,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
     def test_cmd_builder_simple_recipe_no_debversion(self):
         self.build_tree_contents(
             [("recipe", b"# bzr-builder format 0.1\nsource\n")])
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.run_build("recipe working")
         self.assertPathExists("working/a")
         tree = workingtree.WorkingTree.open("working")
@@ -213,13 +335,70 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             b"# bzr-builder format 0.1\nsource revid:%s\n"
             % revid)
 
+    def test_cmd_builder_parallel(self):
+        self.overrideEnv("BZR_BUILDER_PARALLEL", "2")
+        revid = self.make_source_with_file().last_revision()
+        nested_revids = []
+        for name in ["one", "two", "three"]:
+            nested = self.make_branch_and_tree(name)
+            self.build_tree(["%s/%s" % (name, name)])
+            nested.add([name])
+            nested_revids.append(nested.commit(name))
+        self.build_tree_contents(
+            [("recipe", b"# bzr-builder format 0.4\nsource\n"
+              b"nest one one one\nnest two two two\n"
+              b"nest three three three\n")])
+        self.run_build("recipe working")
+        tree = workingtree.WorkingTree.open("working")
+        self.assertEqual(revid, tree.last_revision())
+        for name, nested_revid in zip(
+                ["one", "two", "three"], nested_revids):
+            self.assertPathExists("working/%s/%s" % (name, name))
+            nested = workingtree.WorkingTree.open("working/%s" % name)
+            self.assertEqual(nested_revid, nested.last_revision())
+
+    def test_cmd_builder_lightweight(self):
+        source = self.make_branch_and_tree("source")
+        revid = source.commit("one")
+        other = self.make_branch_and_tree("other")
+        self.build_tree(["other/b"])
+        other.add(["b"])
+        other_revid = other.commit("two")
+        self.build_tree_contents(
+            [("recipe", b"# bzr-builder format 0.4\nsource\n"
+              b"nest other other sub\n")])
+        self.run_build("--lightweight recipe working")
+        self.assertPathExists("working/sub/b")
+        nested = workingtree.WorkingTree.open("working/sub")
+        self.assertEqual(other_revid, nested.last_revision())
+        self.assertEqual(other.branch.base, nested.branch.base)
+        tree = workingtree.WorkingTree.open("working")
+        self.assertEqual(revid, tree.last_revision())
+
+    def test_cmd_builder_lightweight_twice(self):
+        self.make_branch_and_tree("source").commit("one")
+        other = self.make_branch_and_tree("other")
+        self.build_tree(["other/b"])
+        other.add(["b"])
+        other_revid = other.commit("two")
+        other_revid2 = other.commit("three")
+        self.build_tree_contents(
+            [("recipe", b"# bzr-builder format 0.4\nsource\n"
+              b"nest other other sub\n")])
+        self.run_build("--lightweight recipe working")
+        self.build_tree_contents(
+            [("recipe", b"# bzr-builder format 0.4\nsource\n"
+              b"nest other other sub 1\n")])
+        self.run_build("--lightweight recipe working")
+        nested = workingtree.WorkingTree.open("working/sub")
+        self.assertEqual(other.branch.base, nested.branch.base)
+        self.assertEqual(other_revid, nested.last_revision())
+        self.assertEqual(other_revid2, other.branch.last_revision())
+
     def test_cmd_builder_manifest(self):
         self.build_tree_contents(
             [("recipe", b"# bzr-builder format 0.1 deb-version 1\nsource\n")])
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.run_build("recipe working --manifest manifest")
         self.assertPathExists("working/a")
         self.assertPathExists("manifest")
@@ -231,17 +410,11 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.build_tree_contents(
             [("recipe", "# bzr-builder format 0.1 "
               "deb-version 1\nsource\n")])
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        source.commit("one")
+        self.make_source_with_file()
         out, err = self.run_build("recipe working --if-changed-from manifest")
 
     def test_cmd_builder_if_changed_not_changed(self):
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.build_tree_contents(
             [("recipe", "# bzr-builder format 0.1 deb-version 1\nsource 1\n")])
         self.build_tree_contents(
@@ -255,10 +428,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertEqual("Unchanged\n", err)
 
     def test_cmd_builder_if_changed_changed(self):
-        source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
-        source.add(["a"])
-        revid = source.commit("one")
+        revid = self.make_source_with_file().last_revision()
         self.build_tree_contents(
             [("recipe", "# bzr-builder format 0.1 "
                 "deb-version 1\nsource 1\n")])
@@ -276,11 +446,12 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb(self):
         self.requireFeature(NotUnderFakeRootFeature)
-        # TODO: define a test feature for debuild and require it here.
+        self.requireFeature(DebuildFeature)
         source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a", "source/debian/"])
         self.build_tree_contents(
-            [("source/debian/rules", b"#!/usr/bin/make -f\nclean:\n"),
+            [("source/a", b"contents of source/a\n"),
+             ("source/debian/",),
+             ("source/debian/rules", b"#!/usr/bin/make -f\nclean:\n"),
              ("source/debian/control",
                  b"Source: foo\nMaintainer: maint maint@maint.org\n\n"
                  b"Package: foo\nArchitecture: all\n")])
@@ -312,13 +483,14 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_no_work_dir(self):
         self.requireFeature(NotUnderFakeRootFeature)
-        # TODO: define a test feature for debuild and require it here.
+        self.requireFeature(DebuildFeature)
         if getattr(self, "permit_dir", None) is not None:
             self.permit_dir('/')  # Allow the made working dir to be accessed.
         source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a", "source/debian/"])
         self.build_tree_contents(
-            [("source/debian/rules", "#!/usr/bin/make -f\nclean:\n"),
+            [("source/a", "contents of source/a\n"),
+             ("source/debian/",),
+             ("source/debian/rules", "#!/usr/bin/make -f\nclean:\n"),
              ("source/debian/control",
                  "Source: foo\nMaintainer: maint maint@maint.org\n\n"
                  "Package: foo\nArchitecture: all\n")])
@@ -332,13 +504,14 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_if_changed_from_non_existant(self):
         self.requireFeature(NotUnderFakeRootFeature)
-        # TODO: define a test feature for debuild and require it here.
+        self.requireFeature(DebuildFeature)
         if getattr(self, "permit_dir", None) is not None:
             self.permit_dir('/')  # Allow the made working dir to be accessed.
         source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a", "source/debian/"])
         self.build_tree_contents(
-            [("source/debian/rules", "#!/usr/bin/make -f\nclean:\n"),
+            [("source/a", "contents of source/a\n"),
+             ("source/debian/",),
+             ("source/debian/rules", "#!/usr/bin/make -f\nclean:\n"),
              ("source/debian/control",
                  "Source: foo\nMaintainer: maint maint@maint.org\n"
                  "\nPackage: foo\nArchitecture: all\n")])
@@ -387,14 +560,18 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         return tarfile_sha1
 
     def make_simple_package(self, path):
+        """Make a branch at path containing a minimal Debian package."""
+        return self._make_from_template(path, self._make_simple_package)
+
+    def _make_simple_package(self, path):
         source = self.make_branch_and_tree(path)
-        self.build_tree(
-            [os.path.join(path, "a"), os.path.join(path, "debian/")])
         cl_contents = (
             "package (0.1-1) unstable; urgency=low\n  * foo\n"
             " -- maint <maint@maint.org>  Tue, 04 Aug 2009 "
             "10:03:10 +0100\n")
         self.build_tree_contents([
+            (os.path.join(path, "a"), "contents of a\n"),
+            (os.path.join(path, "debian/"),),
             (os.path.join(path, "debian/rules"),
                 "#!/usr/bin/make -f\nclean:\n"),
             (os.path.join(path, "debian/control"),
@@ -422,12 +599,12 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         actual_cl_contents = self._get_file_contents(
             "working/package-1/debian/changelog")
         self.assertStartsWith(actual_cl_contents, new_cl_contents)
-        for fn in os.listdir("working"):
-            self.assertFalse(fn.endswith(".changes"))
+        self.assertEqual(
+            [], [entry.name for entry in os.scandir("working")
+                 if entry.name.endswith(".changes")])
 
     def test_cmd_dailydeb_with_package_from_changelog(self):
-        # TODO: define a test feature for debuild and require it here.
-        self.requireFeature(NotUnderFakeRootFeature)
+        self.skip_source_package_build()
         self.make_simple_package("source")
         self.build_tree_contents(
             [("test.recipe", "# bzr-builder format 0.1 "
@@ -443,7 +620,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertStartsWith(actual_cl_contents, new_cl_contents)
 
     def test_cmd_dailydeb_with_version_from_changelog(self):
-        self.requireFeature(NotUnderFakeRootFeature)
+        self.skip_source_package_build()
         self.make_simple_package("source")
         self.build_tree_contents(
             [("test.recipe", "# bzr-builder format 0.3 "
@@ -456,7 +633,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertEquals("0.1-1-2", str(cl._blocks[0].version))
 
     def test_cmd_dailydeb_with_version_from_other_branch_changelog(self):
-        self.requireFeature(NotUnderFakeRootFeature)
+        self.skip_source_package_build()
         self.make_simple_package("source")
         other = self.make_simple_package("other")
         cl_contents = (
@@ -479,7 +656,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertEquals("0.4-1.2", str(cl._blocks[0].version))
 
     def test_cmd_dailydeb_with_upstream_version_from_changelog(self):
-        self.requireFeature(NotUnderFakeRootFeature)
+        self.skip_source_package_build()
         self.make_simple_package("source")
         self.build_tree_contents(
                 [("test.recipe", "# bzr-builder format 0.1 "
@@ -494,7 +671,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertStartsWith(actual_cl_contents, new_cl_contents)
 
     def test_cmd_dailydeb_with_append_version(self):
-        self.requireFeature(NotUnderFakeRootFeature)
+        self.skip_source_package_build()
         self.make_simple_package("source")
         self.build_tree_contents(
             [("test.recipe", "# bzr-builder format 0.1 "
@@ -509,6 +686,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertStartsWith(actual_cl_contents, new_cl_contents)
 
     def test_cmd_dailydeb_with_nonascii_maintainer_in_changelog(self):
+        self.skip_source_package_build()
         user_enc = osutils.get_user_encoding()
         name = u"Micha\u25c8 Sawicz"
         if sys.version_info >= (3, ):
@@ -535,8 +713,8 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_with_invalid_version(self):
         source = self.make_branch_and_tree("source")
-        self.build_tree(["source/a"])
         self.build_tree_contents([
+            ("source/a", "contents of source/a\n"),
             ("source/debian/", None),
             ("source/debian/control",
              "Source: foo\nMaintainer: maint maint@maint.org\n")
@@ -561,11 +739,17 @@ class BlackboxBuilderTests(TestCaseWithTransport):
         self.assertContainsRe(err, "The 'run' instruction is forbidden.$")
 
     def make_simple_quilt_package(self):
-        source = self.make_simple_package("source")
-        self.build_tree(["source/debian/source/"])
+        """Make a "source" branch containing a minimal quilt package."""
+        return self._make_from_template(
+            "source", self._make_simple_quilt_package)
+
+    def _make_simple_quilt_package(self, path):
+        source = self.make_simple_package(path)
         self.build_tree_contents([
-            ("source/debian/source/format", "3.0 (quilt)\n"),
-            ("source/debian/source/options", 'compression = "gzip"\n')])
+            (os.path.join(path, "debian/source/"),),
+            (os.path.join(path, "debian/source/format"), "3.0 (quilt)\n"),
+            (os.path.join(path, "debian/source/options"),
+                'compression = "gzip"\n')])
         source.add([
             "debian/source", "debian/source/format", "debian/source/options"])
         source.commit("set source format")
@@ -587,6 +771,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_with_orig_tarball(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         self.make_simple_package("source")
         self.make_upstream_version("0.1", [("upstream/file", "content\n")])
         self.build_tree_contents(
@@ -599,6 +784,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_with_pristine_orig_gz_tarball(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         self.requireFeature(PristineTarFeature)
         self.make_simple_package("source")
         pristine_tar_sha1 = self.make_upstream_version(
@@ -616,6 +802,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_with_pristine_orig_bz2_tarball(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         self.requireFeature(PristineTarFeature)
         self.make_simple_quilt_package()
         pristine_tar_sha1 = self.make_upstream_version("0.1", [
@@ -626,8 +813,8 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             [("test.recipe", b"# bzr-builder format 0.3 "
               b"deb-version 0.1-1\nsource\n")])
         wt = workingtree.WorkingTree.open("source")
-        self.build_tree([("source/upstream/")])
         self.build_tree_contents([
+            ("source/upstream/",),
             ("source/upstream/file", "content\n"),
             ("source/upstream/a", "contents of source/a\n")])
         wt.add(["upstream", "upstream/file", "upstream/a"])
@@ -650,8 +837,8 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             [("test.recipe", b"# bzr-builder format 0.3 "
               b"deb-version 0.1-1\nsource\n")])
         wt = workingtree.WorkingTree.open("source")
-        self.build_tree([("source/upstream/")])
         self.build_tree_contents([
+            ("source/upstream/",),
             ("source/upstream/file", "content\n"),
             ("source/upstream/a", "contents of source/a\n")])
         wt.add(["upstream", "upstream/file", "upstream/a"])
@@ -660,14 +847,16 @@ class BlackboxBuilderTests(TestCaseWithTransport):
             retcode=0)
         self.assertPathExists("working/package_0.1.orig.tar.bz2")
         self.assertPathExists("working/package_0.1-1.debian.tar.gz")
-        with open("source/debian/source/format", "r") as f:
-            self.assertEquals("3.0 (quilt)\n", f.read())
+        self.assertEquals(
+            "3.0 (quilt)\n",
+            self._get_file_contents("source/debian/source/format"))
         self.assertEquals(
             osutils.sha_file_by_name("working/package_0.1.orig.tar.bz2"),
             pristine_tar_sha1)
 
     def test_cmd_dailydeb_force_native(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         self.make_simple_quilt_package()
         self.build_tree_contents(
             [("test.recipe", "# bzr-builder format 0.3 "
@@ -680,9 +869,10 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_force_native_empty_series(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         source = self.make_simple_quilt_package()
-        self.build_tree(['source/debian/patches/'])
         self.build_tree_contents([
+            ("source/debian/patches/",),
             ("test.recipe", "# bzr-builder format 0.3 "
              "deb-version 1\nsource 3\n"),
             ("source/debian/patches/series", "\n")])
@@ -698,6 +888,7 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_cmd_dailydeb_force_native_apply_quilt(self):
         self.requireFeature(NotUnderFakeRootFeature)
+        self.requireFeature(DebuildFeature)
         source = self.make_simple_quilt_package()
         self.build_tree(["source/debian/patches/"])
         patch = dedent("""\
@@ -759,8 +950,8 @@ class BlackboxBuilderTests(TestCaseWithTransport):
 
     def test_unknown_source_format(self):
         source = self.make_simple_package("source")
-        self.build_tree(["source/debian/source/"])
         self.build_tree_contents([
+            ("source/debian/source/",),
             ("source/debian/source/format", "2.0\n")])
         source.add(["debian/source", "debian/source/format"])
         source.commit("set source format")
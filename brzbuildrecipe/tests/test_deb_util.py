@@ -0,0 +1,67 @@
+# bzr-builder: a bzr plugin to constuct trees based on recipes
+# Copyright 2009-2011 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from base64 import standard_b64encode
+
+from breezy import (
+    errors,
+    )
+from breezy.tests import (
+    TestCaseInTempDir,
+    )
+
+from .. import deb_util
+
+
+class WritePristineDeltaTests(TestCaseInTempDir):
+
+    def write_delta(self, uuencoded):
+        deb_util._write_pristine_delta(uuencoded, "delta")
+        with open("delta", "rb") as f:
+            return f.read()
+
+    def test_empty(self):
+        self.assertEqual(b"", self.write_delta(""))
+
+    def test_decodes(self):
+        data = bytes(bytearray(range(256))) * 3
+        self.assertEqual(
+            data, self.write_delta(standard_b64encode(data).decode('ascii')))
+
+    def test_decodes_across_chunks(self):
+        # Use a chunk size that isn't a multiple of four, so that groups of
+        # characters get split between chunks.
+        self.overrideAttr(deb_util, "DELTA_CHUNK_SIZE", 7)
+        data = bytes(bytearray(range(100)))
+        self.assertEqual(
+            data, self.write_delta(standard_b64encode(data).decode('ascii')))
+
+    def test_ignores_whitespace(self):
+        self.overrideAttr(deb_util, "DELTA_CHUNK_SIZE", 5)
+        data = b"some pristine-tar delta"
+        encoded = standard_b64encode(data).decode('ascii')
+        self.assertEqual(
+            data, self.write_delta(encoded[:10] + "\n" + encoded[10:] + "\n"))
+
+
+class RunCommandTests(TestCaseInTempDir):
+
+    def test_quiet_failure_includes_output(self):
+        self.overrideAttr(deb_util.trace, "is_quiet", lambda: True)
+        e = self.assertRaises(
+            errors.BzrCommandError, deb_util._run_command,
+            ["sh", "-c", "echo out; echo err >&2; exit 1"], ".",
+            "Running sh", "Running sh failed")
+        self.assertEqual("Running sh failed:\nout\nerr\n", str(e))
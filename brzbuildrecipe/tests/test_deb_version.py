@@ -169,6 +169,20 @@ class ResolveRevisionsTests(TestCaseWithTransport):
         self.assertEqual("1", branch1.revspec)
         self.assertEqual("1-2", branch1.deb_version)
 
+    def test_substitute_dotted_revno(self):
+        source = self.make_branch_and_tree("source")
+        source.commit("one")
+        other = source.controldir.sprout("other").open_workingtree()
+        merged_revid = other.commit("merged")
+        source.merge_from_branch(other.branch)
+        source.commit("merge")
+        branch1 = BaseRecipeBranch(
+            "source", "{revno}", 0.2,
+            revspec="revid:%s" % merged_revid.decode('utf-8'))
+        resolve_revisions(
+            branch1, substitute_branch_vars=substitute_branch_vars)
+        self.assertEqual("1.1.1", branch1.deb_version)
+
     def test_substitute_supports_debupstream(self):
         # resolve_revisions should leave debupstream parameters alone and not
         # complain.
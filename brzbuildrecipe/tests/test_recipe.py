@@ -26,6 +26,7 @@ from breezy.tests import (
         )
 from ..recipe import (
         BaseRecipeBranch,
+        BranchCache,
         build_tree,
         ensure_basedir,
         InstructionParseError,
@@ -37,6 +38,7 @@ from ..recipe import (
         RecipeParser,
         RecipeBranch,
         RecipeParseError,
+        resolve_revisions,
         RUN_INSTRUCTION,
         SAFE_INSTRUCTIONS,
         USAGE,
@@ -634,6 +636,34 @@ class BuildTreeTests(TestCaseWithTransport):
         self.assertEqual(revid, tree.last_revision())
         self.assertEqual(revid, base_branch.revid)
 
+    def test_build_tree_single_branch_resolved(self):
+        source = self.make_branch_and_tree("source")
+        revid = source.commit("one")
+        base_branch = BaseRecipeBranch("source", "1", 0.2)
+        with BranchCache() as cache:
+            resolve_revisions(base_branch, branch_cache=cache)
+            source.commit("two")
+            # The build uses the revision that was resolved through the same
+            # cache.
+            build_tree(base_branch, "target", branch_cache=cache)
+        tree = workingtree.WorkingTree.open("target")
+        self.assertEqual(revid, tree.last_revision())
+        self.assertEqual(revid, base_branch.revid)
+
+    def test_build_tree_nested_twice(self):
+        self.make_source_branch("source1")
+        source2 = self.make_source_branch("source2")
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        nested_branch = RecipeBranch("nested", "source2")
+        base_branch.nest_branch("sub", nested_branch)
+        build_tree(base_branch, "target")
+        source2_rev_id = source2.commit("two")
+        # A later build doesn't reuse the revision the first one built.
+        build_tree(base_branch, "target2")
+        tree = workingtree.WorkingTree.open("target2/sub")
+        self.assertEqual(source2_rev_id, tree.last_revision())
+        self.assertEqual(source2_rev_id, nested_branch.revid)
+
     def make_source_branch(self, relpath):
         """Make a branch with one file and one commit."""
         source1 = self.make_branch_and_tree(relpath)
@@ -657,6 +687,60 @@ class BuildTreeTests(TestCaseWithTransport):
         self.assertEqual(source1_rev_id, base_branch.revid)
         self.assertEqual(source2_rev_id, nested_branch.revid)
 
+    def test_build_tree_nested_lightweight(self):
+        source1_rev_id = self.make_source_branch("source1").last_revision()
+        source2 = self.make_source_branch("source2")
+        source2_rev_id = source2.last_revision()
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        nested_branch = RecipeBranch("nested", "source2")
+        base_branch.nest_branch("sub", nested_branch)
+        build_tree(base_branch, "target", lightweight=True)
+        tree = workingtree.WorkingTree.open("target")
+        self.assertEqual([source1_rev_id], tree.get_parent_ids())
+        # The base branch is always a real branch.
+        self.assertEqual(
+            tree.controldir.root_transport.base,
+            tree.branch.controldir.root_transport.base)
+        tree = workingtree.WorkingTree.open("target/sub")
+        self.assertEqual([source2_rev_id], tree.get_parent_ids())
+        self.assertEqual(source2.branch.base, tree.branch.base)
+        self.assertEqual(source2_rev_id, nested_branch.revid)
+
+    def test_build_tree_nested_lightweight_rebuild(self):
+        self.make_source_branch("source1")
+        source2 = self.make_source_branch("source2")
+        old_rev_id = source2.last_revision()
+        new_rev_id = source2.commit("two")
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        base_branch.nest_branch("sub", RecipeBranch("nested", "source2"))
+        build_tree(base_branch, "target", lightweight=True)
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        base_branch.nest_branch(
+            "sub", RecipeBranch("nested", "source2", revspec="1"))
+        # The checkout from the first build is moved back, and the branch
+        # it was made from is left alone.
+        build_tree(base_branch, "target", lightweight=True)
+        tree = workingtree.WorkingTree.open("target/sub")
+        self.assertEqual(source2.branch.base, tree.branch.base)
+        self.assertEqual([old_rev_id], tree.get_parent_ids())
+        self.assertEqual(new_rev_id, source2.branch.last_revision())
+
+    def test_build_tree_merge_in_to_lightweight_checkout(self):
+        self.make_source_branch("source1")
+        self.make_source_branch("source2")
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        base_branch.nest_branch("sub", RecipeBranch("nested", "source2"))
+        build_tree(base_branch, "target", lightweight=True)
+        nested_branch = RecipeBranch("nested", "source2")
+        nested_branch.merge_branch(RecipeBranch("merged", "source1"))
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        base_branch.nest_branch("sub", nested_branch)
+        e = self.assertRaises(
+            errors.BzrCommandError, build_tree, base_branch, "target")
+        self.assertEqual(
+            "target/sub is a lightweight checkout, so nothing can be merged "
+            "in to it. Build in to a new directory instead.", str(e))
+
     def test_build_tree_merged(self):
         source1 = self.make_source_branch("source1")
         source1_rev_id = source1.last_revision()
@@ -677,6 +761,40 @@ class BuildTreeTests(TestCaseWithTransport):
         self.assertEqual(source1_rev_id, base_branch.revid)
         self.assertEqual(source2_rev_id, merged_branch.revid)
 
+    def test_build_tree_merged_resolved(self):
+        source1 = self.make_source_branch("source1")
+        source2 = source1.controldir.sprout("source2").open_workingtree()
+        self.build_tree_contents([("source2/a", "other change")])
+        source2_rev_id = source2.commit("one")
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        merged_branch = RecipeBranch("merged", "source2")
+        base_branch.merge_branch(merged_branch)
+        with BranchCache() as cache:
+            resolve_revisions(base_branch, branch_cache=cache)
+            self.build_tree_contents([("source2/a", "unwanted change")])
+            source2.commit("two")
+            # The build merges the revision that was resolved through the
+            # same cache.
+            build_tree(base_branch, "target", branch_cache=cache)
+        self.check_file_contents("target/a", b"other change")
+        self.assertEqual(source2_rev_id, merged_branch.revid)
+
+    def test_build_tree_merged_twice(self):
+        source1 = self.make_source_branch("source1")
+        source2 = source1.controldir.sprout("source2").open_workingtree()
+        self.build_tree_contents([("source2/a", "other change")])
+        source2.commit("one")
+        base_branch = BaseRecipeBranch("source1", "1", 0.2)
+        merged_branch = RecipeBranch("merged", "source2")
+        base_branch.merge_branch(merged_branch)
+        build_tree(base_branch, "target")
+        self.build_tree_contents([("source2/a", "new change")])
+        source2_rev_id = source2.commit("two")
+        # A later build doesn't reuse the revision the first one merged.
+        build_tree(base_branch, "target2")
+        self.check_file_contents("target2/a", b"new change")
+        self.assertEqual(source2_rev_id, merged_branch.revid)
+
     def test_build_tree_merge_unrelated(self):
         """Make a branch with one file and one commit."""
         source1 = self.make_branch_and_tree("source1")
@@ -927,6 +1045,45 @@ class BuildTreeTests(TestCaseWithTransport):
         # Changed tag isn't overwritten
         self.assertEqual(first_rev_id, br_to.tags.lookup_tag("one"))
 
+    def test_pull_or_branch_pull_up_to_date(self):
+        source = self.make_branch_and_tree("source")
+        self.build_tree(["source/a"])
+        source.add(["a"])
+        rev_id = source.commit("one")
+        to_transport = transport.get_transport("target")
+        tree_to, br_to = pull_or_branch(
+            None, None, source.branch, to_transport, rev_id)
+        self.addCleanup(tree_to.unlock)
+        self.addCleanup(br_to.unlock)
+        source.branch.tags.set_tag("one", rev_id)
+        tree_to, br_to = pull_or_branch(
+            tree_to, br_to, source.branch, to_transport, rev_id)
+        self.assertEqual(rev_id, tree_to.last_revision())
+        self.assertEqual(rev_id, br_to.last_revision())
+        self.assertTrue(tree_to.is_locked())
+        self.assertTrue(br_to.is_locked())
+        # New tags are still picked up.
+        self.assertEqual(rev_id, br_to.tags.lookup_tag("one"))
+
+    def test_pull_or_branch_checkout_up_to_date(self):
+        source = self.make_branch_and_tree("source")
+        self.build_tree(["source/a"])
+        source.add(["a"])
+        rev_id = source.commit("one")
+        to_transport = transport.get_transport("target")
+        tree_to, br_to = pull_or_branch(
+            None, None, source.branch, to_transport, rev_id,
+            lightweight=True)
+        self.addCleanup(tree_to.unlock)
+        self.addCleanup(br_to.unlock)
+        new_rev_id = source.commit("two")
+        # The branch of the checkout is the source branch, which has moved
+        # on, but the tree is already at the revision that was asked for.
+        tree_to, br_to = pull_or_branch(
+            tree_to, br_to, source.branch, to_transport, rev_id)
+        self.assertEqual(rev_id, tree_to.last_revision())
+        self.assertEqual(new_rev_id, source.branch.last_revision())
+
     def test_pull_or_branch_pull_with_no_tree(self):
         source = self.make_branch_and_tree("source")
         self.build_tree(["source/a"])
@@ -1250,3 +1407,73 @@ class RecipeBranchTests(TestCaseWithTransport):
         self.assertEqual([
             cmd, nest, merge_into_nested],
             list(base_branch.iter_all_instructions()))
+
+
+class BranchCacheTests(TestCaseWithTransport):
+
+    def test_open_reuses_branch(self):
+        self.make_branch("source")
+        with BranchCache() as cache:
+            br = cache.open("source")
+            self.assertIs(br, cache.open("source"))
+            self.assertTrue(br.is_locked())
+        self.assertFalse(br.is_locked())
+
+    def test_prefetch(self):
+        self.make_branch("source1")
+        self.make_branch("source2")
+        with BranchCache() as cache:
+            cache.prefetch(["source1", "source2", "missing"], 2)
+            br = cache.open("source1")
+            self.assertTrue(br.is_locked())
+            self.assertIs(br, cache.open("source1"))
+            self.assertTrue(cache.open("source2").is_locked())
+            self.assertRaises(errors.NotBranchError, cache.open, "missing")
+
+    def test_prefetch_doesnt_share_transports_between_threads(self):
+        self.make_branch("source1")
+        self.make_branch("source2")
+        self.make_branch("source3")
+        possible_transports = []
+        used = []
+        original_open = BranchCache._open
+
+        def _open(cache, url, transports):
+            used.append((url, transports))
+            return original_open(cache, url, transports)
+        self.overrideAttr(BranchCache, "_open", _open)
+        with BranchCache(possible_transports=possible_transports) as cache:
+            cache.prefetch(["source1", "source2", "source3"], 2)
+        self.assertEqual(3, len(used))
+        # The first branch is opened before any threads are started, and the
+        # others each get their own list.
+        self.assertEqual("source1", used[0][0])
+        self.assertIs(possible_transports, used[0][1])
+        threaded = [transports for url, transports in used[1:]]
+        self.assertIsNot(threaded[0], threaded[1])
+        for transports in threaded:
+            self.assertIsNot(possible_transports, transports)
+            for t in transports:
+                self.assertIn(t, possible_transports)
+
+    def test_resolve_revisions_with_cache(self):
+        source = self.make_branch_and_tree("source")
+        revid = source.commit("one")
+        base_branch = BaseRecipeBranch("source", "1", 0.2)
+        nested_branch = RecipeBranch("nested", "source")
+        base_branch.nest_branch("sub", nested_branch)
+        with BranchCache() as cache:
+            resolve_revisions(base_branch, branch_cache=cache)
+            self.assertIs(base_branch.branch, nested_branch.branch)
+        self.assertEqual(revid, base_branch.revid)
+        self.assertEqual(revid, nested_branch.revid)
+
+    def test_revision_id_reused(self):
+        source = self.make_branch_and_tree("source")
+        revid1 = source.commit("one")
+        with BranchCache() as cache:
+            self.assertEqual(revid1, cache.revision_id("source", None))
+            self.assertEqual(revid1, cache.revision_id("source", "1"))
+            source.commit("two")
+            # The revision resolved first is used for the whole build.
+            self.assertEqual(revid1, cache.revision_id("source", None))
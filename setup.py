@@ -17,5 +17,6 @@ setup(name="brz-build-recipe",
           'brzbuildrecipe.tests'],
       scripts=['bin/brz-build-daily-recipe', 'bin/brz-build-recipe'],
       package_dir={'brzbuildrecipe': 'brzbuildrecipe'},
+      python_requires='>=3.5',
       install_requires=['breezy', 'python-debian'],
       test_requires=['fixtures', 'testtools'],)